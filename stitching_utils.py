@@ -2,87 +2,177 @@
 #
 # Utility functions for Via Stitching and Fencing for KiCad.
 
+import array
 import math
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import kipy
 from kipy.board import Board
-from kipy.board_types import (BoardCircle, BoardPolygon, BoardRectangle,
+from kipy.board_types import (BoardArc, BoardBezier, BoardCircle, BoardPolygon, BoardRectangle,
                              BoardSegment, BoardShape, Pad, Track, Via, ArcTrack, Zone)
 from kipy.geometry import Box2, Vector2, PolyLine
-from kipy.geometry import normalize_angle_radians
+from kipy.util import from_mm
 
-def get_polygon_segments(poly: PolyLine) -> list[tuple[Vector2, Vector2]]:
-    """Converts a PolyLine (with points and arcs) into a list of straight line segments."""
-    segments = []
-    if not poly.nodes:
-        return segments
+# Maximum distance between a tessellated chord and the true arc or circle.
+ARC_MAX_ERROR = from_mm(0.01)
 
-    points = []
+# Segment arrays per PolygonWithHoles, dropped automatically when the polygon is garbage collected.
+_POLYGON_SEGMENT_CACHE = weakref.WeakKeyDictionary()
+
+# Budget for one (points x segments) temporary in the tiled kernels; tiles hold as many points as fit.
+TILE_BYTES = 4 * 1024 * 1024
+
+def get_polygon_segments(poly: PolyLine) -> np.ndarray:
+    """Converts a PolyLine (with points and arcs) into an (M, 4) array of straight segments (sx, sy, ex, ey)."""
+    # Coordinates accumulate in flat float64 buffers, so tessellated arcs never become Python ints.
+    xs, ys = array.array('d'), array.array('d')
     for node in poly.nodes:
         if node.has_point:
-            points.append(node.point)
+            point = node.point
+            xs.append(point.x)
+            ys.append(point.y)
         elif node.has_arc:
             arc = node.arc
-            center = arc.center()
-            if not center:
-                points.append(arc.start)
+            arc_points = _tessellate_arc(arc)
+            if arc_points is None:
+                xs.append(arc.start.x)
+                ys.append(arc.start.y)
                 continue
+            xs.frombytes(arc_points[0].tobytes())
+            ys.frombytes(arc_points[1].tobytes())
 
-            radius = arc.radius()
-            start_angle = arc.start_angle()
-            arc_angle_val = arc.angle()
+    return _points_to_segments(np.frombuffer(xs, dtype=np.float64), np.frombuffer(ys, dtype=np.float64), poly.closed)
 
-            if start_angle is None or arc_angle_val is None:
-                points.append(arc.start)
-                continue
+def arc_sweep(arc) -> float | None:
+    """Signed sweep in radians of a start/mid/end arc from start to end, positive counter-clockwise, or None if degenerate.
+
+    kipy's arc.angle() is unsigned, so the direction is taken from which way round the mid point lies.
+    """
+    center = arc.center()
+    if not center:
+        return None
+    start, mid, end = arc.start, arc.mid, arc.end
+    start_angle = math.atan2(start.y - center.y, start.x - center.x)
+    span = (math.atan2(end.y - center.y, end.x - center.x) - start_angle) % (2 * math.pi) or 2 * math.pi
+    to_mid = (math.atan2(mid.y - center.y, mid.x - center.x) - start_angle) % (2 * math.pi)
+    return span if to_mid <= span else span - 2 * math.pi
+
+def _tessellate_arc(arc) -> tuple[np.ndarray, np.ndarray] | None:
+    """Chord vertices (xs, ys) of a start/mid/end arc from start to end, or None if the arc is degenerate."""
+    center, start_angle, sweep = arc.center(), arc.start_angle(), arc_sweep(arc)
+    if not center or start_angle is None or sweep is None:
+        return None
+    radius = arc.radius()
+    angles = np.linspace(start_angle, start_angle + sweep, max(2, arc_tessellation_steps(radius, sweep)) + 1)
+    xs = np.trunc(center.x + radius * np.cos(angles))
+    ys = np.trunc(center.y + radius * np.sin(angles))
+    # Pin the ends to the stored endpoints so the arc meets its neighbouring outline shapes exactly.
+    start, end = arc.start, arc.end
+    xs[0], ys[0], xs[-1], ys[-1] = start.x, start.y, end.x, end.y
+    return xs, ys
 
-            # Tessellate arc into segments
-            num_steps = max(2, int(abs(arc_angle_val) / (math.pi / 18))) # ~10 deg steps
-            for i in range(num_steps + 1):
-                angle = start_angle + (arc_angle_val * i) / num_steps
-                points.append(Vector2.from_xy(
-                    int(center.x + radius * math.cos(angle)),
-                    int(center.y + radius * math.sin(angle))
-                ))
-
-    if len(points) >= 2:
-        for i in range(len(points) - 1):
-            segments.append((points[i], points[i+1]))
-        if poly.closed:
-            segments.append((points[-1], points[0]))
-            
+def _tessellate_bezier(bezier: BoardBezier) -> tuple[np.ndarray, np.ndarray]:
+    """Chord vertices (xs, ys) of a cubic Bezier, sampled finely enough to stay within ARC_MAX_ERROR."""
+    ctrl = np.array([(p.x, p.y) for p in (bezier.start, bezier.control1, bezier.control2, bezier.end)], dtype=np.float64)
+    # The curve deviates from its chords by at most 3/4 of the largest second difference over steps squared.
+    second_diff = max(np.hypot(*(ctrl[i] - 2 * ctrl[i + 1] + ctrl[i + 2])) for i in range(2))
+    steps = max(1, math.ceil(math.sqrt(0.75 * second_diff / ARC_MAX_ERROR)))
+    t = np.linspace(0.0, 1.0, steps + 1)[:, None]
+    points = ((1 - t) ** 3 * ctrl[0] + 3 * (1 - t) ** 2 * t * ctrl[1] + 3 * (1 - t) * t ** 2 * ctrl[2] + t ** 3 * ctrl[3])
+    xs, ys = np.trunc(points[:, 0]), np.trunc(points[:, 1])
+    xs[0], ys[0], xs[-1], ys[-1] = ctrl[0, 0], ctrl[0, 1], ctrl[3, 0], ctrl[3, 1]
+    return xs, ys
+
+def arc_tessellation_steps(radius: float, arc_angle: float) -> int:
+    """Number of chords needed to keep a tessellated arc within ARC_MAX_ERROR of the true curve."""
+    max_step = 2 * math.acos(1 - ARC_MAX_ERROR / max(radius, ARC_MAX_ERROR))
+    return max(1, math.ceil(abs(arc_angle) / max_step))
+
+def _points_to_segments(xs: np.ndarray, ys: np.ndarray, closed: bool) -> np.ndarray:
+    """Pairs consecutive points into an (M, 4) segment array, closing the loop if requested."""
+    n = len(xs)
+    if n < 2:
+        return np.empty((0, 4))
+    segments = np.empty((n if closed else n - 1, 4))
+    segments[:n - 1, 0], segments[:n - 1, 1] = xs[:-1], ys[:-1]
+    segments[:n - 1, 2], segments[:n - 1, 3] = xs[1:], ys[1:]
+    if closed:
+        segments[n - 1] = (xs[-1], ys[-1], xs[0], ys[0])
     return segments
 
-def get_outline_segments(board: Board, shapes: list[BoardShape]) -> list[tuple[Vector2, Vector2]]:
-    """Get all segments from a list of shapes, tessellating curves."""
-    segments = []
+def get_outline_segments(board: Board, shapes: list[BoardShape]) -> np.ndarray:
+    """Get all segments from a list of shapes as an (M, 4) array, tessellating curves.
+
+    Raises on shapes that cannot be turned into edges, since a missing edge leaves the outline open.
+    """
+    segments = [np.empty((0, 4))]
+    # Rectangles and circles are sized from their bounding boxes, fetched in one request.
+    boxed = [s for s in shapes if isinstance(s, (BoardRectangle, BoardCircle))]
+    bboxes = dict(zip(map(id, boxed), get_item_bounding_boxes(board, boxed)))
     for shape in shapes:
         if isinstance(shape, (Zone, BoardPolygon)):
             poly_with_holes = shape.outline if isinstance(shape, Zone) else shape.polygons[0]
-            segments.extend(get_polygon_segments(poly_with_holes.outline))
+            segments.append(get_polygon_segments(poly_with_holes.outline))
             for hole in poly_with_holes.holes:
-                segments.extend(get_polygon_segments(hole))
+                segments.append(get_polygon_segments(hole))
         elif isinstance(shape, BoardRectangle):
-            bbox = board.get_item_bounding_box(shape)
+            bbox = bboxes[id(shape)]
             if bbox:
-                p1, p3 = bbox.pos, Vector2.from_xy(bbox.pos.x + bbox.size.x, bbox.pos.y + bbox.size.y)
-                p2, p4 = Vector2.from_xy(p3.x, p1.y), Vector2.from_xy(p1.x, p3.y)
-                segments.extend([(p1, p2), (p2, p3), (p3, p4), (p4, p1)])
+                x1, y1 = bbox.pos.x, bbox.pos.y
+                x2, y2 = x1 + bbox.size.x, y1 + bbox.size.y
+                segments.append(_points_to_segments(np.array([x1, x2, x2, x1], dtype=np.float64), np.array([y1, y1, y2, y2], dtype=np.float64), True))
         elif isinstance(shape, BoardSegment):
-            segments.append((shape.start, shape.end))
+            start, end = shape.start, shape.end
+            segments.append(np.array([[start.x, start.y, end.x, end.y]], dtype=np.float64))
         elif isinstance(shape, BoardCircle):
-            bbox = board.get_item_bounding_box(shape)
+            bbox = bboxes[id(shape)]
             if bbox:
                 center, radius = bbox.center(), bbox.size.x / 2.0
-                points = [Vector2.from_xy(int(center.x + radius * math.cos(2*math.pi*i/64)), int(center.y + radius * math.sin(2*math.pi*i/64))) for i in range(64)]
-                for i in range(len(points)):
-                    segments.append((points[i], points[(i + 1) % len(points)]))
-    return segments
+                angles = np.linspace(0, 2 * math.pi, max(8, arc_tessellation_steps(radius, 2 * math.pi)), endpoint=False)
+                xs = np.trunc(center.x + radius * np.cos(angles))
+                ys = np.trunc(center.y + radius * np.sin(angles))
+                segments.append(_points_to_segments(xs, ys, True))
+        elif isinstance(shape, BoardArc):
+            arc_points = _tessellate_arc(shape)
+            if arc_points is None:
+                start, end = shape.start, shape.end
+                segments.append(np.array([[start.x, start.y, end.x, end.y]], dtype=np.float64))
+            else:
+                segments.append(_points_to_segments(*arc_points, False))
+        elif isinstance(shape, BoardBezier):
+            segments.append(_points_to_segments(*_tessellate_bezier(shape), False))
+        else:
+            raise Exception(f"Unsupported outline shape: {type(shape).__name__}")
+    return np.concatenate(segments)
+
+def outline_open_ends(segments: np.ndarray, tolerance: float = ARC_MAX_ERROR) -> int:
+    """Number of segment endpoints with no endpoint of another segment within tolerance; zero for closed rings."""
+    ends = segments.reshape(-1, 2).tolist()
+    # Each endpoint is bucketed into every cell within tolerance, so a lookup only checks its own cell.
+    grid = SpatialGrid(tolerance)
+    for i, (x, y) in enumerate(ends):
+        grid.insert(i, x - tolerance, y - tolerance, x + tolerance, y + tolerance)
+    tolerance_sq = tolerance * tolerance
+    return sum(1 for i, (x, y) in enumerate(ends)
+               if not any(j // 2 != i // 2 and (ends[j][0] - x) ** 2 + (ends[j][1] - y) ** 2 <= tolerance_sq
+                          for j in grid.query(x, y)))
+
+def get_item_bounding_boxes(board: Board, items: list) -> list[Box2 | None]:
+    """Fetch bounding boxes for many items in a single API request, aligned with the input list."""
+    if not items: return []
+    bboxes = board.get_item_bounding_box(items)
+    if len(bboxes) == len(items):
+        return bboxes
+    # KiCad skipped items without a bbox, so the batch can't be realigned; query them one by one.
+    return [board.get_item_bounding_box(item) for item in items]
 
 def get_enclosing_bbox(board: Board, shapes: list[BoardShape]) -> Box2 | None:
     """Get the enclosing bounding box for a list of shapes."""
     if not shapes: return None
     
-    bboxes = []
+    bboxes, other_shapes = [], []
     for shape in shapes:
         if isinstance(shape, Zone):
              # Use filled polygons for bbox calculation if available and filled
@@ -96,80 +186,382 @@ def get_enclosing_bbox(board: Board, shapes: list[BoardShape]) -> Box2 | None:
             if shape.polygons:
                 bboxes.append(shape.polygons[0].bounding_box())
         else:
-            item_bbox = board.get_item_bounding_box(shape)
-            if item_bbox:
-                bboxes.append(item_bbox)
+            other_shapes.append(shape)
+
+    # Remaining shapes need KiCad to compute their bounding boxes; ask for all of them in one request.
+    bboxes.extend(b for b in get_item_bounding_boxes(board, other_shapes) if b)
 
     if not bboxes: return None
 
-    final_bbox = bboxes[0]
-    for bbox in bboxes[1:]:
-        final_bbox.merge(bbox)
-        
-    return final_bbox
+    # Merge all boxes with a single min/max reduction over their corners.
+    corners = np.fromiter((v for b in bboxes for v in (b.pos.x, b.pos.y, b.pos.x + b.size.x, b.pos.y + b.size.y)),
+                          dtype=np.int64, count=4 * len(bboxes)).reshape(-1, 4)
+    min_x, min_y = corners[:, :2].min(axis=0).tolist()
+    max_x, max_y = corners[:, 2:].max(axis=0).tolist()
+    return Box2.from_xywh(min_x, min_y, max_x - min_x, max_y - min_y)
+
+def get_polygon_with_holes_segments(poly_with_holes: 'PolygonWithHoles') -> np.ndarray:
+    """Returns the cached (M, 4) segment array covering the outline and all holes of a polygon."""
+    segments = _POLYGON_SEGMENT_CACHE.get(poly_with_holes)
+    if segments is None:
+        segments = np.concatenate([get_polygon_segments(poly_with_holes.outline)] +
+                                  [get_polygon_segments(hole) for hole in poly_with_holes.holes])
+        _POLYGON_SEGMENT_CACHE[poly_with_holes] = segments
+    return segments
 
 def is_point_inside_polygon_with_holes(point: Vector2, poly_with_holes: 'PolygonWithHoles') -> bool:
     """Checks if a point is inside a polygon with holes."""
-    outline_segments = get_polygon_segments(poly_with_holes.outline)
-    if not is_point_inside_segments(point, outline_segments):
-        return False
-    for hole in poly_with_holes.holes:
-        hole_segments = get_polygon_segments(hole)
-        if is_point_inside_segments(point, hole_segments):
-            return False
-    return True
-
-def is_point_inside_segments(point: Vector2, segments: list[tuple[Vector2, Vector2]]) -> bool:
-    """Checks if a point is inside a shape defined by segments using the ray casting algorithm."""
-    intersections = 0
-    for start, end in segments:
-        if start.y == end.y: continue
-        if min(start.y, end.y) < point.y <= max(start.y, end.y):
-            if (point.x < (end.x - start.x) * (point.y - start.y) / (end.y - start.y) + start.x):
-                intersections += 1
-    return intersections % 2 == 1
+    # Holes lie within the outline, so even-odd parity over all rings at once excludes them.
+    return is_point_inside_segments(point, get_polygon_with_holes_segments(poly_with_holes))
+
+def is_point_inside_segments(point: Vector2, segments: np.ndarray) -> bool:
+    """Checks if a point is inside a shape defined by an (M, 4) segment array using the ray casting algorithm."""
+    px, py = np.array([point.x], dtype=np.float64), np.array([point.y], dtype=np.float64)
+    return bool(points_inside_segments(px, py, segments)[0])
+
+def _tile_rows(columns: int) -> int:
+    """Points per tile so a float64 (tile, columns) temporary stays within TILE_BYTES."""
+    return max(256, TILE_BYTES // (8 * max(columns, 1)))
+
+def _for_each_tile(n: int, tile: int, fn):
+    """Calls fn(start, stop) for every tile of n rows, spread over a thread pool when there are several.
+
+    NumPy releases the GIL inside its array kernels, and every tile writes a disjoint slice of the output.
+    """
+    starts = range(0, n, tile)
+    if len(starts) <= 1:
+        for start in starts:
+            fn(start, min(start + tile, n))
+        return
+    with ThreadPoolExecutor() as pool:
+        list(pool.map(lambda start: fn(start, min(start + tile, n)), starts))
+
+def points_inside_segments(px: np.ndarray, py: np.ndarray, segments: np.ndarray,
+                           tile: int | None = None) -> np.ndarray:
+    """Even-odd ray casting of P points against an (M, 4) segment array, as a (P,) boolean mask."""
+    inside = np.zeros(len(px), dtype=bool)
+    if len(segments) == 0:
+        return inside
+    # Sort by lower y so each tile only scans the band of segments its y range can cross.
+    low_y = np.minimum(segments[:, 1], segments[:, 3])
+    order = np.argsort(low_y, kind='stable')
+    low_y, high_y = low_y[order], np.maximum(segments[:, 1], segments[:, 3])[order]
+    sx, sy, ex, ey = (segments[order, i] for i in range(4))
+    dx, dy = ex - sx, ey - sy
+    # Points outside the bounding box of the segments can't be inside; only ray cast the rest.
+    in_box = np.flatnonzero((px >= segments[:, [0, 2]].min()) & (px <= segments[:, [0, 2]].max()) &
+                            (py >= low_y[0]) & (py <= high_y.max()))
+
+    def cast_tile(start: int, stop: int):
+        rows = in_box[start:stop]
+        px_t, py_t = px[rows], py[rows]
+        band = np.flatnonzero(high_y[:np.searchsorted(low_y, py_t.max(), side='right')] >= py_t.min())
+        if len(band) == 0: return
+        inside[rows] = _ray_cast_parity(px_t, py_t, sx[band], sy[band], ey[band], dx[band], dy[band])
+
+    _for_each_tile(len(in_box), tile or _tile_rows(len(segments)), cast_tile)
+    return inside
+
+def _ray_cast_parity(px: np.ndarray, py: np.ndarray, sx: np.ndarray, sy: np.ndarray, ey: np.ndarray,
+                     dx: np.ndarray, dy: np.ndarray) -> np.ndarray:
+    """Even-odd crossing parity of P points against S segments given by start, end y and deltas."""
+    py_col = py[:, None]
+    # A segment spans py when exactly one endpoint lies below it, so horizontal segments never count.
+    # The crossing lies right of the point when the cross product's sign is opposite to the segment's dy,
+    # which avoids both the division and a branch on segment direction.
+    spans = (sy < py_col) != (ey < py_col)
+    cross = (px[:, None] - sx) * dy - (py_col - sy) * dx
+    return (np.count_nonzero(spans & (cross * dy < 0), axis=1) & 1).astype(bool)
+
+def points_outline_check(px: np.ndarray, py: np.ndarray, segments: np.ndarray, max_distance: float = math.inf,
+                         tile: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """Fused points_inside_segments and points_segments_min_distance_sq over an (S, 4) segment array.
+
+    Each tile of points is ray cast and measured in the same pass, returning the (P,) inside mask
+    and the (P,) squared distance to the nearest segment (inf beyond max_distance).
+    """
+    inside, dist_sq = np.zeros(len(px), dtype=bool), np.full(len(px), np.inf)
+    if len(segments) == 0:
+        return inside, dist_sq
+    low_y = np.minimum(segments[:, 1], segments[:, 3])
+    order = np.argsort(low_y, kind='stable')
+    low_y, high_y = low_y[order], np.maximum(segments[:, 1], segments[:, 3])[order]
+    sx, sy, ex, ey = (segments[order, i] for i in range(4))
+    dx, dy = ex - sx, ey - sy
+    min_x, max_x = np.minimum(sx, ex) - max_distance, np.maximum(sx, ex) + max_distance
+
+    def check_tile(start: int, stop: int):
+        px_t, py_t = px[start:stop], py[start:stop]
+        y0, y1 = py_t.min(), py_t.max()
+        band = np.flatnonzero(high_y[:np.searchsorted(low_y, y1, side='right')] >= y0)
+        if len(band):
+            inside[start:stop] = _ray_cast_parity(px_t, py_t, sx[band], sy[band], ey[band], dx[band], dy[band])
+        near = np.flatnonzero((min_x <= px_t.max()) & (max_x >= px_t.min()) &
+                              (low_y - max_distance <= y1) & (high_y + max_distance >= y0))
+        if len(near):
+            dist_sq[start:stop] = points_segments_distance_sq(px_t, py_t, sx[near], sy[near], ex[near], ey[near]).min(axis=1)
+
+    _for_each_tile(len(px), tile or _tile_rows(len(segments)), check_tile)
+    return inside, dist_sq
+
+def points_outline_mask(px: np.ndarray, py: np.ndarray, segments: np.ndarray, margin: float,
+                        cell_size: float) -> np.ndarray:
+    """Returns a boolean mask of the points inside the outline and at least margin from every segment.
+
+    The points are rasterized onto cell_size cells. A cell whose center is more than margin plus its half
+    diagonal away from the outline lies wholly on one side of it, so its points take the center's verdict;
+    only points in cells near the outline pay for the exact points_outline_check.
+    """
+    keep = np.zeros(len(px), dtype=bool)
+    if len(px) == 0 or len(segments) == 0:
+        return keep
+    cells, group = np.unique(np.stack([px // cell_size, py // cell_size], axis=1), axis=0, return_inverse=True)
+    group = group.ravel()
+    centers = (cells + 0.5) * cell_size
+    reach = margin + cell_size * math.sqrt(0.5)
+    center_inside, center_dist_sq = points_outline_check(centers[:, 0], centers[:, 1], segments, reach)
+    settled = center_dist_sq > reach * reach
+    keep[:] = (settled & center_inside)[group]
+    exact = np.flatnonzero(~settled[group])
+    inside, dist_sq = points_outline_check(px[exact], py[exact], segments, margin)
+    keep[exact] = inside & (dist_sq >= margin * margin)
+    return keep
+
+def segment_distance_sq(px: float, py: float, ax: float, ay: float, bx: float, by: float) -> float:
+    """Squared shortest distance from point (px, py) to the segment (ax, ay)-(bx, by)."""
+    abx, aby = bx - ax, by - ay
+    apx, apy = px - ax, py - ay
+    l2 = abx * abx + aby * aby
+    if l2 == 0.0: return apx * apx + apy * apy
+    t = max(0, min(1, (apx * abx + apy * aby) / l2))
+    dx, dy = apx - t * abx, apy - t * aby
+    return dx * dx + dy * dy
+
+def point_segment_distance_sq(p: Vector2, a: Vector2, b: Vector2) -> float:
+    """Calculates the squared shortest distance from a point to a line segment."""
+    return segment_distance_sq(p.x, p.y, a.x, a.y, b.x, b.y)
 
 def point_segment_distance(p: Vector2, a: Vector2, b: Vector2) -> float:
     """Calculates the shortest distance from a point to a line segment."""
-    ab, ap = b - a, p - a
-    l2 = ab.x**2 + ab.y**2
-    if l2 == 0.0: return ap.length()
-    t = max(0, min(1, (ap.x * ab.x + ap.y * ab.y) / l2))
-    projection = a + ab * t
-    return (p - projection).length()
+    return math.sqrt(segment_distance_sq(p.x, p.y, a.x, a.y, b.x, b.y))
 
 def point_arc_distance(p: Vector2, arc: ArcTrack) -> float:
     """Calculates the shortest distance from a point to an arc track."""
-    center = arc.center()
-    if not center:
-        return point_segment_distance(p, arc.start, arc.end)
+    return math.sqrt(point_arc_distance_sq(p, arc))
 
-    radius = arc.radius()
-    cp = p - center
-    dist_to_center = cp.length()
+def point_arc_distance_sq(p: Vector2, arc: ArcTrack) -> float:
+    """Calculates the squared shortest distance from a point to an arc track."""
+    geometry = get_arc_geometry(arc)
+    if geometry is None:
+        return point_segment_distance_sq(p, arc.start, arc.end)
+    return arc_distance_sq(p.x, p.y, geometry)
+
+def arc_distance_sq(px: float, py: float, geometry: tuple[float, ...]) -> float:
+    """Squared shortest distance from point (px, py) to an arc given as a get_arc_geometry row."""
+    cx, cy, radius, start_angle, sweep, sx, sy, ex, ey, _ = geometry
+    dx, dy = px - cx, py - cy
+    # Angle of the point measured from the arc start in the sweep's direction, wrapped into [0, 2*pi).
+    if ((math.atan2(dy, dx) - start_angle) * math.copysign(1.0, sweep)) % (2 * math.pi) <= abs(sweep):
+        return (math.hypot(dx, dy) - radius) ** 2
+    return min((px - sx) ** 2 + (py - sy) ** 2, (px - ex) ** 2 + (py - ey) ** 2)
+
+def point_polygon_distance(p: Vector2, poly: 'PolygonWithHoles') -> float:
+    """Calculates the shortest distance from a point to a polygon's boundary."""
+    return point_segments_distance(p, get_polygon_with_holes_segments(poly))
 
-    start_angle = normalize_angle_radians((arc.start - center).angle())
-    p_angle = normalize_angle_radians(cp.angle())
-    arc_total_angle = arc.angle()
+def point_segments_distance(p: Vector2, segments: np.ndarray) -> float:
+    """Calculates the shortest distance from a point to any segment of an (M, 4) segment array."""
+    if len(segments) == 0:
+        return float('inf')
 
-    if arc_total_angle is None:
-        return point_segment_distance(p, arc.start, arc.end)
+    px, py = np.array([p.x], dtype=np.float64), np.array([p.y], dtype=np.float64)
+    return math.sqrt(points_segments_distance_sq(px, py, segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]).min())
 
-    delta_angle = normalize_angle_radians(p_angle - start_angle)
+def points_circles_distance_sq(px: np.ndarray, py: np.ndarray, cx: np.ndarray, cy: np.ndarray) -> np.ndarray:
+    """Squared distances from P points to C circle centers as a (P, C) array."""
+    dx, dy = px[:, None] - cx[None, :], py[:, None] - cy[None, :]
+    return dx * dx + dy * dy
 
-    if 0 <= delta_angle <= arc_total_angle:
-        return abs(dist_to_center - radius)
-    else:
-        return min((p - arc.start).length(), (p - arc.end).length())
+def points_segments_distance_sq(px: np.ndarray, py: np.ndarray, ax: np.ndarray, ay: np.ndarray,
+                                bx: np.ndarray, by: np.ndarray) -> np.ndarray:
+    """Squared shortest distances from P points to S line segments as a (P, S) array."""
+    abx, aby = bx - ax, by - ay
+    l2 = abx * abx + aby * aby
+    apx, apy = px[:, None] - ax[None, :], py[:, None] - ay[None, :]
+    t = np.clip((apx * abx + apy * aby) / np.where(l2 > 0, l2, 1.0), 0.0, 1.0)
+    dx, dy = apx - t * abx, apy - t * aby
+    return dx * dx + dy * dy
 
-def point_polygon_distance(p: Vector2, poly: 'PolygonWithHoles') -> float:
-    """Calculates the shortest distance from a point to a polygon's boundary."""
-    outline_segments = get_polygon_segments(poly.outline)
+def points_segments_min_distance_sq(px: np.ndarray, py: np.ndarray, segments: np.ndarray,
+                                    max_distance: float = math.inf, tile: int | None = None) -> np.ndarray:
+    """Squared distance from each of P points to the nearest row of an (S, 4) segment array, as a (P,) array.
+
+    Points are processed in tiles so the (tile, S) temporaries stay within TILE_BYTES. Segments whose
+    bounding box, grown by max_distance, misses a tile are skipped, so distances of at least
+    max_distance may be reported as inf.
+    """
+    out = np.full(len(px), np.inf)
+    if len(segments) == 0:
+        return out
+    ax, ay, bx, by = segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]
+    min_x, max_x = np.minimum(ax, bx) - max_distance, np.maximum(ax, bx) + max_distance
+    min_y, max_y = np.minimum(ay, by) - max_distance, np.maximum(ay, by) + max_distance
+
+    def reduce_tile(start: int, stop: int):
+        px_t, py_t = px[start:stop], py[start:stop]
+        near = np.flatnonzero((min_x <= px_t.max()) & (max_x >= px_t.min()) & (min_y <= py_t.max()) & (max_y >= py_t.min()))
+        if len(near) == 0: return
+        out[start:stop] = points_segments_distance_sq(px_t, py_t, ax[near], ay[near], bx[near], by[near]).min(axis=1)
+
+    _for_each_tile(len(px), tile or _tile_rows(len(segments)), reduce_tile)
+    return out
+
+def points_boxes_distance_sq(px: np.ndarray, py: np.ndarray, cx: np.ndarray, cy: np.ndarray,
+                             half_w: np.ndarray, half_h: np.ndarray, angle: np.ndarray | None = None) -> np.ndarray:
+    """Squared distances from P points to B boxes as a (P, B) array, zero inside a box.
+
+    angle optionally gives each box's rotation in radians; points are rotated into the box frame.
+    """
+    dx, dy = px[:, None] - cx[None, :], py[:, None] - cy[None, :]
+    if angle is not None and angle.any():
+        cos, sin = np.cos(angle)[None, :], np.sin(angle)[None, :]
+        dx, dy = dx * cos - dy * sin, dx * sin + dy * cos
+    dx = np.maximum(np.abs(dx) - half_w[None, :], 0.0)
+    dy = np.maximum(np.abs(dy) - half_h[None, :], 0.0)
+    return dx * dx + dy * dy
+
+def get_arc_geometry(arc: ArcTrack) -> tuple[float, ...] | None:
+    """Returns an arc track's (cx, cy, radius, start_angle, sweep, sx, sy, ex, ey, half_width) row, or None if degenerate.
+
+    sweep is signed as in arc_sweep, so clockwise arcs keep their side of the chord.
+    """
+    center, sweep = arc.center(), arc_sweep(arc)
+    if not center or sweep is None:
+        return None
+    cx, cy = center.x, center.y
+    start, end = arc.start, arc.end
+    sx, sy = start.x - cx, start.y - cy
+    return cx, cy, math.hypot(sx, sy), math.atan2(sy, sx) % (2 * math.pi), sweep, start.x, start.y, end.x, end.y, arc.width / 2.0
+
+def points_arcs_distance_sq(px: np.ndarray, py: np.ndarray, arcs: np.ndarray) -> np.ndarray:
+    """Squared distances from P points to A arcs given as get_arc_geometry rows, as a (P, A) array.
+
+    Matches point_arc_distance: the radial distance inside the arc's sweep, else the nearer endpoint.
+    """
+    dx, dy = px[:, None] - arcs[:, 0], py[:, None] - arcs[:, 1]
+    delta = ((np.arctan2(dy, dx) - arcs[:, 3]) * np.copysign(1.0, arcs[:, 4])) % (2 * math.pi)
+    radial = np.sqrt(dx * dx + dy * dy) - arcs[:, 2]
+    end_sq = np.minimum(points_circles_distance_sq(px, py, arcs[:, 5], arcs[:, 6]),
+                        points_circles_distance_sq(px, py, arcs[:, 7], arcs[:, 8]))
+    return np.where(delta <= np.abs(arcs[:, 4]), radial * radial, end_sq)
+
+def points_track_distance_sq(px: np.ndarray, py: np.ndarray, item) -> np.ndarray:
+    """Squared distances from P points to the centerline of a track, segment or arc track, as a (P,) array."""
+    geometry = get_arc_geometry(item) if isinstance(item, ArcTrack) else None
+    if geometry:
+        return points_arcs_distance_sq(px, py, np.array([geometry], dtype=np.float64))[:, 0]
+    start, end = item.start, item.end
+    return points_segments_distance_sq(px, py, np.array([start.x], dtype=np.float64), np.array([start.y], dtype=np.float64),
+                                       np.array([end.x], dtype=np.float64), np.array([end.y], dtype=np.float64))[:, 0]
+
+def obstacle_clearance_mask(px: np.ndarray, py: np.ndarray, reach: float, vias: np.ndarray,
+                            pads: np.ndarray, tracks: np.ndarray, arcs: np.ndarray,
+                            cell_size: float = 0) -> np.ndarray:
+    """Returns a boolean mask of the points clearing every via, pad, track and arc obstacle.
+
+    reach is the new via's radius plus copper clearance. vias is (V, 3) of (x, y, radius),
+    pads is (P, 5) of (cx, cy, half_w, half_h, angle), tracks is (T, 5) of (sx, sy, ex, ey, half_width)
+    and arcs is (A, 10) of get_arc_geometry rows.
+    With a positive cell_size the obstacles are bucketed on a SpatialGrid and the points of each
+    cell are only tested against the obstacles overlapping that cell.
+    """
+    if cell_size <= 0 or len(px) == 0:
+        return _obstacle_clearance_mask(px, py, reach, vias, pads, tracks, arcs)
+
+    grid = SpatialGrid(cell_size)
+    for i, (x, y, r) in enumerate(vias.tolist()):
+        grid.insert((0, i), x - r - reach, y - r - reach, x + r + reach, y + r + reach)
+    for i, (x, y, hw, hh, a) in enumerate(pads.tolist()):
+        if a:
+            # The circumscribed square covers the box at any rotation.
+            hw = hh = math.hypot(hw, hh)
+        grid.insert((1, i), x - hw - reach, y - hh - reach, x + hw + reach, y + hh + reach)
+    for i, (sx, sy, ex, ey, hw) in enumerate(tracks.tolist()):
+        m = hw + reach
+        grid.insert((2, i), min(sx, ex) - m, min(sy, ey) - m, max(sx, ex) + m, max(sy, ey) + m)
+    for i, (cx, cy, r, *_, hw) in enumerate(arcs.tolist()):
+        m = r + hw + reach
+        grid.insert((3, i), cx - m, cy - m, cx + m, cy + m)
+
+    # Group the points by grid cell, then run the dense kernel once per occupied cell.
+    keep = np.ones(len(px), dtype=bool)
+    cells = np.stack([px // cell_size, py // cell_size], axis=1)
+    _, group = np.unique(cells, axis=0, return_inverse=True)
+    order = np.argsort(group.ravel(), kind='stable')
+    cell_members = np.split(order, np.flatnonzero(np.diff(group.ravel()[order])) + 1)
+
+    def check_cells(start: int, stop: int):
+        for members in cell_members[start:stop]:
+            hits = grid.query(px[members[0]], py[members[0]])
+            if not hits: continue
+            by_kind = ([], [], [], [])
+            for kind, i in hits:
+                by_kind[kind].append(i)
+            keep[members] = _obstacle_clearance_mask(px[members], py[members], reach, vias[by_kind[0]],
+                                                     pads[by_kind[1]], tracks[by_kind[2]], arcs[by_kind[3]])
+
+    # The grid is only read and each cell writes its own points, so runs of cells are split across the pool.
+    _for_each_tile(len(cell_members), max(256, -(-len(cell_members) // (os.cpu_count() or 1))), check_cells)
+    return keep
+
+def _obstacle_clearance_mask(px: np.ndarray, py: np.ndarray, reach: float, vias: np.ndarray,
+                             pads: np.ndarray, tracks: np.ndarray, arcs: np.ndarray,
+                             tile: int | None = None) -> np.ndarray:
+    """Brute-force obstacle_clearance_mask testing every point against every obstacle."""
+    tile = tile or _tile_rows(max(len(vias), len(pads), len(tracks), len(arcs)))
+    if len(px) > tile:
+        # Bound the (points x obstacles) temporaries on large candidate sets.
+        return np.concatenate([_obstacle_clearance_mask(px[i:i + tile], py[i:i + tile], reach, vias, pads, tracks, arcs, tile)
+                               for i in range(0, len(px), tile)])
+    # Narrow the surviving indices stage by stage, cheapest test first. Thresholds are squared, so no sqrt is taken.
+    idx = np.arange(len(px))
+    if len(vias) and len(idx):
+        d_sq = points_circles_distance_sq(px[idx], py[idx], vias[:, 0], vias[:, 1])
+        idx = idx[~(d_sq < (reach + vias[:, 2]) ** 2).any(axis=1)]
+    if len(pads) and len(idx):
+        # Broad phase against the pad boxes inflated by reach (circumscribed for rotated pads);
+        # only points inside one of them pay for the exact distance.
+        half_w = np.where(pads[:, 4] != 0, np.hypot(pads[:, 2], pads[:, 3]), pads[:, 2]) + reach
+        half_h = np.where(pads[:, 4] != 0, np.hypot(pads[:, 2], pads[:, 3]), pads[:, 3]) + reach
+        near = ((np.abs(px[idx, None] - pads[:, 0]) < half_w) & (np.abs(py[idx, None] - pads[:, 1]) < half_h)).any(axis=1)
+        near_idx = idx[near]
+        if len(near_idx):
+            d_sq = points_boxes_distance_sq(px[near_idx], py[near_idx], pads[:, 0], pads[:, 1], pads[:, 2], pads[:, 3], pads[:, 4])
+            idx = np.concatenate([idx[~near], near_idx[~(d_sq < reach * reach).any(axis=1)]])
+    if len(tracks) and len(idx):
+        d_sq = points_segments_distance_sq(px[idx], py[idx], tracks[:, 0], tracks[:, 1], tracks[:, 2], tracks[:, 3])
+        idx = idx[~(d_sq < (reach + tracks[:, 4]) ** 2).any(axis=1)]
+    if len(arcs) and len(idx):
+        d_sq = points_arcs_distance_sq(px[idx], py[idx], arcs)
+        idx = idx[~(d_sq < (reach + arcs[:, 9]) ** 2).any(axis=1)]
+
+    keep = np.zeros(len(px), dtype=bool)
+    keep[idx] = True
+    return keep
+
+class SpatialGrid:
+    """Uniform grid that buckets items by every cell their bounding box overlaps."""
 
-    min_dist = min((point_segment_distance(p, s, e) for s, e in outline_segments), default=float('inf'))
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.cells: dict[tuple[int, int], list] = {}
 
-    for hole in poly.holes:
-        hole_segments = get_polygon_segments(hole)
-        min_dist = min(min_dist, min((point_segment_distance(p, s, e) for s, e in hole_segments), default=float('inf')))
+    def insert(self, item, min_x: float, min_y: float, max_x: float, max_y: float):
+        c = self.cell_size
+        for ix in range(int(min_x // c), int(max_x // c) + 1):
+            for iy in range(int(min_y // c), int(max_y // c) + 1):
+                self.cells.setdefault((ix, iy), []).append(item)
 
-    return min_dist
+    def query(self, x: float, y: float) -> list:
+        """Returns the items whose inserted bounding box may contain the point."""
+        return self.cells.get((int(x // self.cell_size), int(y // self.cell_size)), [])
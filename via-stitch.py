@@ -6,7 +6,7 @@ import wx
 import sys
 import math
 import logging
-import random
+import numpy as np
 import kipy
 from kipy.board import Board
 from kipy.board_types import (BoardCircle, BoardPolygon, BoardRectangle,
@@ -15,105 +15,74 @@ from kipy.errors import ApiError
 from kipy.geometry import Box2, Vector2
 from kipy.util import from_mm
 from kipy.util.board_layer import BoardLayer, is_copper_layer
-from kipy.geometry import normalize_angle_radians
 from kipy.proto.common.types import KiCadObjectType
+from stitching_utils import (SpatialGrid, get_arc_geometry, get_enclosing_bbox, get_item_bounding_boxes, obstacle_clearance_mask,
+                             points_circles_distance_sq, points_inside_segments, points_outline_check,
+                             points_segments_min_distance_sq)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Backend Logic (Helper Functions) ---
 
-def get_outline_segments(board: Board, shapes: list[BoardShape]) -> list[tuple[Vector2, Vector2]]:
-    segments = []
+def get_outline_segments(board: Board, shapes: list[BoardShape]) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the outline as an (S, 4) array of (start_x, start_y, end_x, end_y) rows plus a (K, 3) array of (cx, cy, r) circles."""
+    segments, circles = [], []
+    # Rectangles and circles are sized from their bounding boxes, fetched in one request.
+    boxed = [s for s in shapes if isinstance(s, (BoardRectangle, BoardCircle))]
+    bboxes = dict(zip(map(id, boxed), get_item_bounding_boxes(board, boxed)))
     for shape in shapes:
         if isinstance(shape, BoardPolygon):
             if shape.polygons and shape.polygons[0].outline.nodes:
-                points = [node.point for node in shape.polygons[0].outline if node.has_point]
+                points = [(node.point.x, node.point.y) for node in shape.polygons[0].outline if node.has_point]
                 if len(points) >= 2:
                     for i in range(len(points)):
-                        segments.append((points[i], points[(i + 1) % len(points)]))
+                        segments.append((*points[i], *points[(i + 1) % len(points)]))
         elif isinstance(shape, BoardRectangle):
-            bbox = board.get_item_bounding_box(shape)
+            bbox = bboxes[id(shape)]
             if bbox:
-                p1, p3 = bbox.pos, Vector2.from_xy(bbox.pos.x + bbox.size.x, bbox.pos.y + bbox.size.y)
-                p2, p4 = Vector2.from_xy(p3.x, p1.y), Vector2.from_xy(p1.x, p3.y)
-                segments.extend([(p1, p2), (p2, p3), (p3, p4), (p4, p1)])
+                x1, y1 = bbox.pos.x, bbox.pos.y
+                x2, y2 = x1 + bbox.size.x, y1 + bbox.size.y
+                segments.extend([(x1, y1, x2, y1), (x2, y1, x2, y2), (x2, y2, x1, y2), (x1, y2, x1, y1)])
         elif isinstance(shape, BoardSegment):
-            segments.append((shape.start, shape.end))
+            segments.append((shape.start.x, shape.start.y, shape.end.x, shape.end.y))
         elif isinstance(shape, BoardCircle):
-            bbox = board.get_item_bounding_box(shape)
+            bbox = bboxes[id(shape)]
             if bbox:
-                center, radius = bbox.center(), bbox.size.x / 2.0
-                points = [Vector2.from_xy(int(center.x + radius * math.cos(2*math.pi*i/64)), int(center.y + radius * math.sin(2*math.pi*i/64))) for i in range(64)]
-                for i in range(len(points)):
-                    segments.append((points[i], points[(i + 1) % len(points)]))
-    return segments
-
-def get_enclosing_bbox(board: Board, shapes: list[BoardShape]) -> Box2 | None:
-    if not shapes: return None
-    bboxes = [b for b in board.get_item_bounding_box(shapes) if b]
-    if not bboxes: return None
-    min_x, min_y = min(b.pos.x for b in bboxes), min(b.pos.y for b in bboxes)
-    max_x, max_y = max(b.pos.x + b.size.x for b in bboxes), max(b.pos.y + b.size.y for b in bboxes)
-    pos = Vector2.from_xy(min_x, min_y)
-    size = Vector2.from_xy(max_x - min_x, max_y - min_y)
-    return Box2(pos.proto, size.proto)
-
-def is_point_inside_outline(point: Vector2, segments: list[tuple[Vector2, Vector2]]) -> bool:
-    intersections = 0
-    for start, end in segments:
-        if start.y == end.y: continue
-        if min(start.y, end.y) < point.y <= max(start.y, end.y):
-            if (point.x < (end.x - start.x) * (point.y - start.y) / (end.y - start.y) + start.x):
-                intersections += 1
-    return intersections % 2 == 1
-
-def point_segment_distance(p: Vector2, a: Vector2, b: Vector2) -> float:
-    ab, ap = b - a, p - a
-    l2 = ab.x**2 + ab.y**2
-    if l2 == 0.0: return ap.length()
-    t = max(0, min(1, (ap.x * ab.x + ap.y * ab.y) / l2))
-    projection = a + ab * t
-    return (p - projection).length()
-
-def point_arc_distance(p: Vector2, arc: ArcTrack) -> float:
-    center = arc.center()
-    if not center:
-        return point_segment_distance(p, arc.start, arc.end)
-
-    radius = arc.radius()
-    cp = p - center
-    dist_to_center = cp.length()
-
-    start_angle = normalize_angle_radians((arc.start - center).angle())
-    p_angle = normalize_angle_radians(cp.angle())
-    arc_total_angle = arc.angle()
-
-    if arc_total_angle is None: # Should not happen if center is valid
-        return point_segment_distance(p, arc.start, arc.end)
-
-    delta_angle = normalize_angle_radians(p_angle - start_angle)
-
-    if 0 <= delta_angle <= arc_total_angle:
-        return abs(dist_to_center - radius)
-    else:
-        return min((p - arc.start).length(), (p - arc.end).length())
-
-def point_polygon_distance(p: Vector2, poly: BoardPolygon) -> float:
-    segments = []
-    if poly.polygons and poly.polygons[0].outline.nodes:
-        points = [node.point for node in poly.polygons[0].outline if node.has_point]
-        if len(points) >= 2:
-            for i in range(len(points)):
-                segments.append((points[i], points[(i + 1) % len(points)]))
-
-    if not segments:
+                # Circles stay exact: containment and edge distance are closed-form in the radius.
+                center = bbox.center()
+                circles.append((center.x, center.y, bbox.size.x / 2.0))
+    return np.asarray(segments, dtype=np.float64).reshape(-1, 4), np.asarray(circles, dtype=np.float64).reshape(-1, 3)
+
+def get_polygon_outline_segments(poly: 'PolygonWithHoles') -> np.ndarray:
+    """Returns a polygon's outline as an (S, 4) array of (start_x, start_y, end_x, end_y) rows."""
+    points = [(node.point.x, node.point.y) for node in poly.outline if node.has_point]
+    if len(points) < 2:
+        return np.empty((0, 4))
+    return np.asarray([(*points[i], *points[(i + 1) % len(points)]) for i in range(len(points))], dtype=np.float64)
+
+def point_polygon_distance_sq(x: float, y: float, segments: np.ndarray) -> float:
+    """Squared distance from (x, y) to a polygon outline given as segments, zero inside it."""
+    if len(segments) == 0:
         return float('inf')
 
     # Simple check for holes is omitted for performance.
-    if is_point_inside_outline(p, segments):
+    px, py = np.array([x], dtype=np.float64), np.array([y], dtype=np.float64)
+    if points_inside_segments(px, py, segments)[0]:
         return 0.0
 
-    return min(point_segment_distance(p, s, e) for s, e in segments)
+    return float(points_segments_min_distance_sq(px, py, segments)[0])
+
+
+def get_pad_box(pad: Pad, bbox: Box2 | None) -> tuple[float, float, float, float, float] | None:
+    """Returns a pad's (cx, cy, half_w, half_h, angle_radians) clearance box, or None if it has no extent."""
+    angle = pad.padstack.angle.degrees
+    layers = pad.padstack.copper_layers
+    if angle % 90 != 0 and layers and layers[0].offset.length() == 0:
+        # Off-axis pads get an oriented box; their axis-aligned bbox would block the corners around them.
+        pos, size = pad.position, layers[0].size
+        return pos.x, pos.y, size.x / 2.0, size.y / 2.0, math.radians(angle)
+    if not bbox: return None
+    return bbox.pos.x + bbox.size.x / 2.0, bbox.pos.y + bbox.size.y / 2.0, bbox.size.x / 2.0, bbox.size.y / 2.0, 0.0
 
 
 # --- GUI Dialog Definition ---
@@ -122,6 +91,7 @@ class StitcherDialog(wx.Dialog):
     def __init__(self, parent):
         super(StitcherDialog, self).__init__(parent, title="Via Stitching Tool", style=wx.DEFAULT_DIALOG_STYLE | wx.STAY_ON_TOP)
         self.kicad, self.board = None, None
+        self.nets_by_name, self.netclasses_by_name = {}, {}
         top_sizer = wx.BoxSizer(wx.VERTICAL)
         panel = wx.Panel(self)
         grid_sizer = wx.GridBagSizer(5, 5)
@@ -200,14 +170,18 @@ class StitcherDialog(wx.Dialog):
 
     def populate_data(self):
         try:
-            self.kicad, self.board = kipy.KiCad(), kipy.KiCad().get_board()
+            self.kicad = kipy.KiCad()
+            self.board = self.kicad.get_board()
             all_nets = sorted(self.board.get_nets(), key=lambda n: n.code)
+            # Keep the nets and netclasses fetched here so stitching doesn't query KiCad for them again.
+            self.nets_by_name = {n.name: n for n in all_nets}
             net_names = [n.name for n in all_nets if "unconnected" not in n.name.lower()]
             self.m_net_choice.Append("[No Net]"), self.m_net_choice.Append(net_names), self.m_net_choice.SetSelection(0)
             netclasses = []
             if all_nets:
                 netclass_map = self.board.get_netclass_for_nets(all_nets)
-                netclasses = sorted(list(set(nc.name for nc in netclass_map.values())))
+                self.netclasses_by_name = {nc.name: nc for nc in netclass_map.values()}
+                netclasses = sorted(self.netclasses_by_name)
             self.m_netclass_choice.Append(netclasses)
             if "Default" in netclasses: self.m_netclass_choice.SetStringSelection("Default")
             elif len(netclasses) > 0: self.m_netclass_choice.SetSelection(0)
@@ -255,13 +229,15 @@ class StitcherDialog(wx.Dialog):
         else:
             target_netclass_name = params['netclass_name']
             if not target_netclass_name: raise Exception("No netclass selected.")
-            nets_in_class = self.board.get_nets(netclass_filter=target_netclass_name)
-            if not nets_in_class: raise Exception(f"Netclass '{target_netclass_name}' not found.")
-            netclass_obj = list(self.board.get_netclass_for_nets(nets_in_class[0]).values())[0]
+            netclass_obj = self.netclasses_by_name.get(target_netclass_name)
+            if not netclass_obj: raise Exception(f"Netclass '{target_netclass_name}' not found.")
             via_size_nm, drill_size_nm = netclass_obj.via_diameter, netclass_obj.via_drill
             if not via_size_nm or not drill_size_nm: raise Exception(f"Netclass '{target_netclass_name}' has invalid via dimensions.")
 
         spacing_nm = from_mm(params['spacing'])
+        if spacing_nm <= 0:
+            raise ValueError("Spacing must be a positive value.")
+
         edge_clearance_nm = from_mm(params['edge_clearance'])
         clearance_nm = from_mm(params['clearance'])
         row_offset_nm = from_mm(params['row_offset'])
@@ -272,10 +248,10 @@ class StitcherDialog(wx.Dialog):
         
         outline_shapes = [s for s in self.board.get_shapes() if s.layer == BoardLayer.BL_Edge_Cuts]
         if not outline_shapes: raise Exception("No valid board outline found.")
-        outline_segments, bbox = get_outline_segments(self.board, outline_shapes), get_enclosing_bbox(self.board, outline_shapes)
+        (outline, outline_circles), bbox = get_outline_segments(self.board, outline_shapes), get_enclosing_bbox(self.board, outline_shapes)
         if not bbox: raise Exception("Could not determine board bounding box.")
         
-        target_net = next((n for n in self.board.get_nets() if n.name == params['net_name']), None) if params['net_name'] else None
+        target_net = self.nets_by_name.get(params['net_name']) if params['net_name'] else None
         
         # --- Collect all obstacles once ---
         obstacles = []
@@ -304,81 +280,140 @@ class StitcherDialog(wx.Dialog):
             else:
                 obstacles.append({'item': item, 'net': net, 'type': item.__class__.__name__})
 
+        # Same-net obstacles never conflict with the new vias; drop them once instead of per candidate.
+        if target_net:
+            obstacles = [obs for obs in obstacles if not (obs['net'] and obs['net'].name == target_net.name)]
+
         # --- Generate candidate positions ---
-        candidate_positions = []
         center = bbox.center()
-        half_cols = int(bbox.size.x / (2.0 * spacing_nm)) if spacing_nm > 0 else 0
-        half_rows = int(bbox.size.y / (2.0 * spacing_nm)) if spacing_nm > 0 else 0
-        for i in range(-half_rows, half_rows + 1):
-            row_x_offset = row_offset_nm if i % 2 != 0 else 0
-            for j in range(-half_cols, half_cols + 1):
-                x_pos = center.x + j * spacing_nm + row_x_offset
-                y_pos = center.y + i * spacing_nm
-
-                if random_variance:
-                    x_pos += random.uniform(-max_x_variance_nm, max_x_variance_nm)
-                    y_pos += random.uniform(-max_y_variance_nm, max_y_variance_nm)
-
-                pos = Vector2.from_xy(int(x_pos), int(y_pos))
-                if not is_point_inside_outline(pos, outline_segments): continue
-                if min(point_segment_distance(pos, s, e) for s, e in outline_segments) < via_radius_nm + edge_clearance_nm: continue
-                candidate_positions.append(pos)
-
-        if not candidate_positions:
+        half_cols = int(bbox.size.x / (2.0 * spacing_nm))
+        half_rows = int(bbox.size.y / (2.0 * spacing_nm))
+        rows, cols = np.meshgrid(np.arange(-half_rows, half_rows + 1), np.arange(-half_cols, half_cols + 1), indexing='ij')
+        xs = center.x + cols * spacing_nm + np.where(rows % 2 != 0, row_offset_nm, 0)
+        ys = center.y + rows * spacing_nm
+        if random_variance:
+            # One draw covers both axes; the per-axis bounds broadcast over the last dimension.
+            jitter = np.random.uniform((-max_x_variance_nm, -max_y_variance_nm), (max_x_variance_nm, max_y_variance_nm), xs.shape + (2,))
+            xs, ys = xs + jitter[..., 0], ys + jitter[..., 1]
+        # Truncate to whole nanometres once; the filters below all run on these float64 arrays.
+        xs, ys = np.trunc(xs.ravel()).astype(np.float64), np.trunc(ys.ravel()).astype(np.float64)
+
+        # Cheap box test first: a point closer than the edge clearance to the bbox is also too close to the outline.
+        edge_margin = via_radius_nm + edge_clearance_nm
+        in_box = ((xs >= bbox.pos.x + edge_margin) & (xs <= bbox.pos.x + bbox.size.x - edge_margin) &
+                  (ys >= bbox.pos.y + edge_margin) & (ys <= bbox.pos.y + bbox.size.y - edge_margin))
+        xs, ys = xs[in_box], ys[in_box]
+
+        # Containment and edge clearance for every remaining candidate at once.
+        # Each circle is a closed ring, so its containment toggles the even-odd parity like a polygon's would.
+        inside, edge_dist_sq = points_outline_check(xs, ys, outline, max_distance=edge_margin)
+        circle_dist_sq = points_circles_distance_sq(xs, ys, outline_circles[:, 0], outline_circles[:, 1])
+        inside ^= (np.count_nonzero(circle_dist_sq < outline_circles[:, 2] ** 2, axis=1) & 1).astype(bool)
+        clear = inside & (edge_dist_sq >= edge_margin ** 2)
+        if len(outline_circles):
+            clear &= (np.abs(np.sqrt(circle_dist_sq) - outline_circles[:, 2]) >= edge_margin).all(axis=1)
+        xs, ys = xs[clear], ys[clear]
+
+        if len(xs) == 0:
             raise Exception("No valid positions for vias found within board outline and edge clearance.")
 
-        # --- Filter candidates and create valid vias ---
-        valid_vias = []
-        for pos in candidate_positions:
+        # --- Vectorized clearance checks against vias, shapes, pads, tracks and arcs ---
+        # Each obstacle type is gathered once into a numeric array. Pads are tested analytically as
+        # (possibly rotated) boxes, and shapes as the circle around their bounding box, like vias.
+        via_items = [obs['item'] for obs in obstacles if isinstance(obs['item'], Via)]
+        shape_items = [obs['item'] for obs in obstacles if isinstance(obs['item'], BoardShape)]
+        pad_items = [obs['item'] for obs in obstacles if isinstance(obs['item'], Pad)]
+        track_items = [obs['item'] for obs in obstacles if isinstance(obs['item'], Track)]
+        arc_items = [obs['item'] for obs in obstacles if isinstance(obs['item'], ArcTrack)]
+        circle_rows = [(v.position.x, v.position.y, v.diameter / 2.0) for v in via_items]
+        for shape_bbox in get_item_bounding_boxes(self.board, shape_items):
+            # An empty bbox never conflicts.
+            if shape_bbox and shape_bbox.center().length() > 0:
+                center = shape_bbox.center()
+                circle_rows.append((center.x, center.y, max(shape_bbox.size.x, shape_bbox.size.y) / 2.0))
+        circles = np.asarray(circle_rows, dtype=np.float64).reshape(-1, 3)
+        pad_rows = [get_pad_box(p, b) for p, b in zip(pad_items, get_item_bounding_boxes(self.board, pad_items))]
+        pads = np.asarray([r for r in pad_rows if r], dtype=np.float64).reshape(-1, 5)
+        arc_rows = [get_arc_geometry(a) for a in arc_items]
+        # Degenerate arcs are checked as the straight track between their endpoints.
+        track_items += [a for a, row in zip(arc_items, arc_rows) if row is None]
+        tracks = np.asarray([(t.start.x, t.start.y, t.end.x, t.end.y, t.width / 2.0) for t in track_items], dtype=np.float64).reshape(-1, 5)
+        arcs = np.asarray([row for row in arc_rows if row], dtype=np.float64).reshape(-1, 10)
+
+        # Drop obstacles that can't reach any candidate, i.e. those entirely outside the board bbox grown by the via reach.
+        reach = via_radius_nm + clearance_nm
+        lo_x, lo_y = bbox.pos.x - reach, bbox.pos.y - reach
+        hi_x, hi_y = bbox.pos.x + bbox.size.x + reach, bbox.pos.y + bbox.size.y + reach
+        def in_window(x, y, r): return (x + r >= lo_x) & (x - r <= hi_x) & (y + r >= lo_y) & (y - r <= hi_y)
+        circles = circles[in_window(circles[:, 0], circles[:, 1], circles[:, 2])]
+        pads = pads[in_window(pads[:, 0], pads[:, 1], np.hypot(pads[:, 2], pads[:, 3]))]
+        tracks = tracks[in_window((tracks[:, 0] + tracks[:, 2]) / 2.0, (tracks[:, 1] + tracks[:, 3]) / 2.0,
+                                  np.hypot(tracks[:, 2] - tracks[:, 0], tracks[:, 3] - tracks[:, 1]) / 2.0 + tracks[:, 4])]
+        arcs = arcs[in_window(arcs[:, 0], arcs[:, 1], arcs[:, 2] + arcs[:, 9])]
+
+        keep = obstacle_clearance_mask(xs, ys, reach,
+                                      circles, pads, tracks, arcs, cell_size=4 * spacing_nm)
+        xs, ys = xs[keep], ys[keep]
+
+        # Survivors stay plain (x, y) tuples; Vector2 and Via objects are only built where needed.
+        candidate_positions = list(zip(xs.astype(np.int64).tolist(), ys.astype(np.int64).tolist()))
+
+        # --- Index the zone polygons on a uniform grid ---
+        # Extents are inflated by the via clearance radius, so a candidate only needs the polygons in its own cell.
+        obstacle_grid = SpatialGrid(4 * spacing_nm)
+        reach_sq = reach * reach
+        for obs in obstacles:
+            if obs['type'] != 'zone_poly': continue
+            zone_bbox = obs['item'].bounding_box()
+            min_x, min_y = zone_bbox.pos.x, zone_bbox.pos.y
+            max_x, max_y = min_x + zone_bbox.size.x, min_y + zone_bbox.size.y
+            if max_x < lo_x or min_x > hi_x or max_y < lo_y or min_y > hi_y: continue
+            # Circle around the extent: a candidate farther than reach from it can't touch the polygon.
+            half_w, half_h = (max_x - min_x) / 2.0, (max_y - min_y) / 2.0
+            obs['near'] = (min_x + half_w, min_y + half_h, (reach + math.hypot(half_w, half_h)) ** 2)
+            # Segmentize each polygon once; every candidate near it reuses the same array.
+            obs['segments'] = get_polygon_outline_segments(obs['item'])
+            obstacle_grid.insert(obs, min_x - reach, min_y - reach, max_x + reach, max_y + reach)
+
+        # --- Filter surviving candidates and create valid vias ---
+        # Distances are compared squared so the hot loop never takes a square root.
+        spacing_sq = spacing_nm * spacing_nm
+        placed = []
+        # Accepted vias are hashed by their spacing box, so only the ones within spacing share a cell with a candidate.
+        placed_grid = SpatialGrid(spacing_nm)
+        query = obstacle_grid.query
+        # Without jitter the grid rows and columns are already spacing_nm apart, so only jittered grids need the check.
+        check_spacing = random_variance and (max_x_variance_nm > 0 or max_y_variance_nm > 0)
+        for x, y in candidate_positions:
             is_valid = True
             # Check against spacing of already added valid vias
-            for v in valid_vias:
-                if (pos - v.position).length() < spacing_nm:
+            if check_spacing:
+                for vx, vy in placed_grid.query(x, y):
+                    dx, dy = x - vx, y - vy
+                    if dx * dx + dy * dy < spacing_sq:
+                        is_valid = False; break
+                if not is_valid: continue
+
+            # Check against the zone fills near this position
+            for obs in query(x, y):
+                # Cheapest test first: skip polygons whose bounding circle is out of reach.
+                cx, cy, near_sq = obs['near']
+                if (x - cx) ** 2 + (y - cy) ** 2 >= near_sq: continue
+                # clearance is from edge
+                if point_polygon_distance_sq(x, y, obs['segments']) < reach_sq:
                     is_valid = False; break
-            if not is_valid: continue
-
-            # Check against all board obstacles
-            for obs in obstacles:
-                if target_net and obs['net'] and obs['net'].name == target_net.name:
-                    continue
-
-                item = obs['item']
-                dist = float('inf')
-                obs_clearance = 0
-
-                if isinstance(item, Via):
-                    dist = (pos - item.position).length()
-                    obs_clearance = item.diameter / 2.0
-                elif isinstance(item, Pad):
-                    dist = (pos - item.position).length()
-                    obs_clearance = max(item.padstack.copper_layer(BoardLayer.BL_F_Cu).size.x, item.padstack.copper_layer(BoardLayer.BL_F_Cu).size.y) / 2.0 if item.padstack.copper_layer(BoardLayer.BL_F_Cu) else 0
-                elif isinstance(item, Track):
-                    dist = point_segment_distance(pos, item.start, item.end)
-                    obs_clearance = item.width / 2.0
-                elif isinstance(item, ArcTrack):
-                    dist = point_arc_distance(pos, item)
-                    obs_clearance = item.width / 2.0
-                elif isinstance(item, BoardShape):
-                    # Simplified check for board shapes
-                    bbox = self.board.get_item_bounding_box(item)
-                    if bbox and bbox.center().length() > 0: # check if valid bbox
-                        dist = (pos - bbox.center()).length()
-                        obs_clearance = max(bbox.size.x, bbox.size.y) / 2.0
-                elif obs['type'] == 'zone_poly':
-                    # This is slow, only check if bbox overlaps
-                    bbox = item.bounding_box()
-                    if (pos - bbox.center()).length() < (via_radius_nm + max(bbox.size.x, bbox.size.y)/2.0 + clearance_nm):
-                        dist = point_polygon_distance(pos, item)
-                        obs_clearance = 0 # clearance is from edge
-
-                if dist < via_radius_nm + obs_clearance + clearance_nm:
-                    is_valid = False; break
-            
+
             if is_valid:
-                via = Via()
-                via.position, via.diameter, via.drill_diameter = pos, via_size_nm, drill_size_nm
-                if target_net: via.net = target_net
-                valid_vias.append(via)
+                placed.append((x, y))
+                if check_spacing:
+                    placed_grid.insert((x, y), x - spacing_nm, y - spacing_nm, x + spacing_nm, y + spacing_nm)
+
+        valid_vias = []
+        for x, y in placed:
+            via = Via()
+            via.position, via.diameter, via.drill_diameter = Vector2.from_xy(x, y), via_size_nm, drill_size_nm
+            if target_net: via.net = target_net
+            valid_vias.append(via)
 
         if not valid_vias:
             return 0
@@ -9,6 +9,7 @@ import logging
 import random
 import kipy
 import argparse
+import numpy as np
 from kipy.board import Board
 from kipy.board_types import (Track, Via, ArcTrack, BoardSegment, Zone, Pad, ViaType, BoardShape, BoardText, BoardTextBox)
 from kipy.errors import ApiError
@@ -25,6 +26,7 @@ class FenceDialog(wx.Dialog):
         super(FenceDialog, self).__init__(parent, title="Via Fencing Tool", style=wx.DEFAULT_DIALOG_STYLE | wx.STAY_ON_TOP)
         self.debug_mode = False
         self.kicad, self.board = None, None
+        self.nets_by_name, self.netclasses_by_name = {}, {}
         top_sizer = wx.BoxSizer(wx.VERTICAL)
         panel = wx.Panel(self)
         grid_sizer = wx.GridBagSizer(5, 5)
@@ -102,7 +104,9 @@ class FenceDialog(wx.Dialog):
             self.selected_items = [s for s in self.selection if isinstance(s, (Track, ArcTrack, BoardSegment))]
             
             all_nets = sorted(self.board.get_nets(), key=lambda n: n.name)
+            self.nets_by_name = {n.name: n for n in all_nets}
             net_names = [n.name for n in all_nets if "unconnected" not in n.name.lower()]
+            net_indices = {name: i for i, name in enumerate(net_names)}
             self.m_net_choice.Append("[No Net]"), self.m_net_choice.Append(net_names), self.m_net_choice.SetSelection(0)
 
             if self.selected_items:
@@ -115,7 +119,8 @@ class FenceDialog(wx.Dialog):
 
                 if item_layer is not None:
                     all_zones = self.board.get_zones()
-                    zones_on_layer = [z for z in all_zones if item_layer in z.layers and not z.is_rule_area() and z.net is not None]
+                    # Only filled copper zones can supply a net; unfilled ones never have their polygons fetched.
+                    zones_on_layer = [z for z in all_zones if z.filled and item_layer in z.layers and not z.is_rule_area() and z.net is not None]
                     
                     closest_zone = None
                     min_dist = float('inf')
@@ -126,39 +131,39 @@ class FenceDialog(wx.Dialog):
                     elif isinstance(first_item, ArcTrack):
                         item_midpoint = first_item.mid
 
-                    if item_midpoint:
+                    if item_midpoint and zones_on_layer:
+                        px, py = np.array([item_midpoint.x], dtype=np.float64), np.array([item_midpoint.y], dtype=np.float64)
                         for zone in zones_on_layer:
-                            if not zone.filled: continue
-                            for layer, polys in zone.filled_polygons.items():
-                                if layer == item_layer:
-                                    for poly in polys:
-                                        dist = point_polygon_distance(item_midpoint, poly)
-                                        if dist < min_dist:
-                                            min_dist = dist
-                                            closest_zone = zone
+                            for poly in zone.filled_polygons.get(item_layer, []):
+                                segments = get_polygon_with_holes_segments(poly)
+                                if len(segments) == 0: continue
+                                # A polygon whose bounding box is already farther than the best match can't win.
+                                xs, ys = segments[:, 0::2], segments[:, 1::2]
+                                dx = max(xs.min() - px[0], 0, px[0] - xs.max())
+                                dy = max(ys.min() - py[0], 0, py[0] - ys.max())
+                                if dx * dx + dy * dy >= min_dist * min_dist: continue
+                                dist = math.sqrt(points_segments_min_distance_sq(px, py, segments, min_dist)[0])
+                                if dist < min_dist:
+                                    min_dist = dist
+                                    closest_zone = zone
                     
                     if closest_zone:
                         default_net_name = closest_zone.net.name
 
                 if default_net_name:
-                    try:
-                        idx = net_names.index(default_net_name)
-                        self.m_net_choice.SetSelection(idx + 1)
-                    except ValueError:
-                        pass
+                    idx = net_indices.get(default_net_name)
+                    if idx is not None: self.m_net_choice.SetSelection(idx + 1)
                 elif hasattr(first_item, 'net'):
                     item_net = first_item.net
                     if item_net:
-                        try:
-                            idx = net_names.index(item_net.name)
-                            self.m_net_choice.SetSelection(idx + 1)
-                        except ValueError:
-                            pass
+                        idx = net_indices.get(item_net.name)
+                        if idx is not None: self.m_net_choice.SetSelection(idx + 1)
             
             netclasses = []
             if all_nets:
                 netclass_map = self.board.get_netclass_for_nets(all_nets)
-                netclasses = sorted(list(set(nc.name for nc in netclass_map.values())))
+                self.netclasses_by_name = {nc.name: nc for nc in netclass_map.values()}
+                netclasses = sorted(self.netclasses_by_name)
             self.m_netclass_choice.Append(netclasses)
             if "Default" in netclasses: self.m_netclass_choice.SetStringSelection("Default")
             elif len(netclasses) > 0: self.m_netclass_choice.SetSelection(0)
@@ -202,53 +207,48 @@ class FenceDialog(wx.Dialog):
             self.m_fence_button.Enable()
             wx.EndBusyCursor()
 
-    def _generate_candidates(self, item, spacing_nm, distance_nm, via_radius_nm, num_rows, row_offset_nm, sides):
+    def _generate_candidates(self, item, spacing_nm, distance_nm, via_radius_nm, num_rows, row_offset_nm, sides) -> np.ndarray:
+        """Returns the fence positions alongside an item as an (N, 2) array of truncated nm coordinates."""
         points = []
         item_width = getattr(item, 'width', 0)
 
         if distance_nm <= item_width / 2 + via_radius_nm:
             logging.warning("Distance from trace is too small, vias may overlap the trace.")
 
+        is_arc = isinstance(item, ArcTrack)
+        if isinstance(item, (Track, BoardSegment)):
+            start, end = item.start, item.end
+            sx, sy = start.x, start.y
+            dx, dy = end.x - sx, end.y - sy
+            length = math.hypot(dx, dy)
+            if length == 0: return np.empty((0, 2))
+            ux, uy = dx / length, dy / length
+        elif is_arc:
+            center = item.center()
+            start_angle, arc_angle_val = item.start_angle(), arc_sweep(item)
+            if not center or start_angle is None or arc_angle_val is None: return np.empty((0, 2))
+            cx, cy, radius = center.x, center.y, item.radius()
+        else:
+            return np.empty((0, 2))
+
         for row in range(1, num_rows + 1):
             current_dist = distance_nm + (row - 1) * row_offset_nm
             for side in sides:
                 offset_dist = current_dist + item_width / 2
-                if isinstance(item, (Track, BoardSegment)):
-                    p1, p2 = item.start, item.end
-                    length = (p2 - p1).length()
-                    if length == 0: continue
-
-                    num_vias = round(length / spacing_nm) + 1
-                    if num_vias > 1:
-                        actual_spacing = length / (num_vias - 1)
-                        direction = (p2 - p1) * (1.0 / length)
-                        perp_dir = Vector2.from_xy(-direction.y, direction.x)
-                        offset = perp_dir * offset_dist * side
-                        for i in range(num_vias):
-                            points.append(p1 + direction * (actual_spacing * i) + offset)
-                elif isinstance(item, ArcTrack):
-                    center = item.center()
-                    if not center: continue
-                    
-                    radius = item.radius()
+                if is_arc:
                     new_radius = radius + offset_dist * side
                     if new_radius <= 0: continue
-
-                    start_angle = item.start_angle()
-                    arc_angle_val = item.angle()
-                    if start_angle is None or arc_angle_val is None: continue
-                    
-                    length = abs(arc_angle_val) * new_radius
+                    num_vias = round(abs(arc_angle_val) * new_radius / spacing_nm) + 1
+                    if num_vias > 1:
+                        angles = start_angle + (arc_angle_val / (num_vias - 1)) * np.arange(num_vias)
+                        points.append(np.column_stack((cx + new_radius * np.cos(angles), cy + new_radius * np.sin(angles))))
+                else:
                     num_vias = round(length / spacing_nm) + 1
                     if num_vias > 1:
-                        angle_step = arc_angle_val / (num_vias - 1)
-                        for i in range(num_vias):
-                            angle = start_angle + angle_step * i
-                            points.append(Vector2.from_xy(
-                                int(center.x + new_radius * math.cos(angle)),
-                                int(center.y + new_radius * math.sin(angle))
-                            ))
-        return points
+                        ts = np.linspace(0, length, num_vias)
+                        offset = offset_dist * side
+                        points.append(np.column_stack((sx + ux * ts - uy * offset, sy + uy * ts + ux * offset)))
+        return np.trunc(np.concatenate(points)) if points else np.empty((0, 2))
 
     def perform_fencing(self, params: dict) -> int | None:
         logging.info(f"Starting fencing with params: {params}")
@@ -257,9 +257,8 @@ class FenceDialog(wx.Dialog):
         else:
             target_netclass_name = params['netclass_name']
             if not target_netclass_name: raise Exception("No netclass selected.")
-            nets_in_class = self.board.get_nets(netclass_filter=target_netclass_name)
-            if not nets_in_class: raise Exception(f"Netclass '{target_netclass_name}' not found.")
-            netclass_obj = list(self.board.get_netclass_for_nets(nets_in_class[0]).values())[0]
+            netclass_obj = self.netclasses_by_name.get(target_netclass_name)
+            if not netclass_obj: raise Exception(f"Netclass '{target_netclass_name}' not found.")
             via_size_nm, drill_size_nm = netclass_obj.via_diameter, netclass_obj.via_drill
             if not via_size_nm or not drill_size_nm: raise Exception(f"Netclass '{target_netclass_name}' has invalid via dimensions.")
 
@@ -273,15 +272,28 @@ class FenceDialog(wx.Dialog):
         row_offset_nm = from_mm(params['row_offset'])
         clearance_nm = from_mm(params['clearance'])
         
-        target_net = next((n for n in self.board.get_nets() if n.name == params['net_name']), None) if params['net_name'] else None
+        target_net = self.nets_by_name.get(params['net_name']) if params['net_name'] else None
 
-        obstacles = []
         all_items = self.board.get_items([KiCadObjectType.KOT_PCB_TRACE, KiCadObjectType.KOT_PCB_ARC])
-        selected_ids = [item.id for item in self.selected_items]
+        selected_ids = frozenset(item.id.value for item in self.selected_items)
+        # Obstacles are stored column-wise: one float row per track or arc, with same-net copper dropped up front.
+        target_net_name = target_net.name if target_net else None
+        track_rows, arc_rows = [], []
         for item in all_items:
-            if item.id in selected_ids: continue
-            obstacles.append({'item': item, 'net': getattr(item, 'net', None), 'type': item.__class__.__name__})
-        logging.info(f"Collected {len(obstacles)} trace obstacles.")
+            if item.id.value in selected_ids: continue
+            net = getattr(item, 'net', None)
+            if target_net_name and net and net.name == target_net_name: continue
+            is_arc = isinstance(item, ArcTrack)
+            geometry = get_arc_geometry(item) if is_arc else None
+            if geometry:
+                arc_rows.append(geometry)
+            elif is_arc or isinstance(item, Track):
+                # Degenerate arcs are checked as the straight track between their endpoints.
+                start, end = item.start, item.end
+                track_rows.append((start.x, start.y, end.x, end.y, item.width / 2.0))
+        tracks = np.asarray(track_rows, dtype=np.float64).reshape(-1, 5)
+        arcs = np.asarray(arc_rows, dtype=np.float64).reshape(-1, 10)
+        logging.info(f"Collected {len(tracks) + len(arcs)} trace obstacles.")
 
         candidate_points = []
         if params['is_diff_pair']:
@@ -293,76 +305,79 @@ class FenceDialog(wx.Dialog):
             points1 = self._generate_candidates(item1, spacing_nm, distance_nm, via_radius_nm, params['num_rows'], row_offset_nm, sides)
             points2 = self._generate_candidates(item2, spacing_nm, distance_nm, via_radius_nm, params['num_rows'], row_offset_nm, sides)
 
-            midpoints = [(p1+p2)*0.5 for p1, p2 in zip(points1, points2)] if len(points1) == len(points2) else []
-
-            for p in points1 + points2:
-                is_outer = True
-                for mid in midpoints:
-                    if (p-mid).length() < (item1.position - mid).length() or (p-mid).length() < (item2.position - mid).length():
-                        is_outer = False
-                        break
-                if is_outer:
-                    candidate_points.append(p)
+            candidates = np.concatenate((points1, points2))
+
+            # The pair's gap is measured from the middle of the first trace to the second one's centerline.
+            middle = item1.mid if isinstance(item1, ArcTrack) else (item1.start + item1.end) * 0.5
+            gap_sq = points_track_distance_sq(np.array([middle.x], dtype=np.float64), np.array([middle.y], dtype=np.float64), item2)[0]
+            # A candidate is outer when the other trace is at least the gap away and farther than its own trace,
+            # which drops rows between the traces as well as rows pushed past the partner trace.
+            px, py = candidates[:, 0], candidates[:, 1]
+            dist1_sq, dist2_sq = points_track_distance_sq(px, py, item1), points_track_distance_sq(px, py, item2)
+            from_first = np.arange(len(candidates)) < len(points1)
+            own_sq, other_sq = np.where(from_first, dist1_sq, dist2_sq), np.where(from_first, dist2_sq, dist1_sq)
+            is_outer = other_sq >= np.maximum(own_sq, gap_sq)
+            candidate_points = candidates[is_outer].tolist()
         else:
             for item in self.selected_items:
                 sides = [-1, 1]
                 if not is_copper_layer(item.layer):
                     sides = [1]
-                candidate_points.extend(self._generate_candidates(item, spacing_nm, distance_nm, via_radius_nm, params['num_rows'], row_offset_nm, sides))
+                candidate_points.extend(self._generate_candidates(item, spacing_nm, distance_nm, via_radius_nm, params['num_rows'], row_offset_nm, sides).tolist())
 
         logging.info(f"Generated {len(candidate_points)} initial candidate points.")
 
-        items_to_create = []
-        validated_points = []
-        for pos in candidate_points:
+        # --- Vectorized clearance checks against tracks and arcs ---
+        reach = via_radius_nm + clearance_nm
+        # Tracks and arcs are masked separately so debug labels can still name the conflicting kind.
+        candidates = np.asarray(candidate_points, dtype=np.float64).reshape(-1, 2)
+        no_vias, no_pads, no_tracks, no_arcs = np.empty((0, 3)), np.empty((0, 5)), np.empty((0, 5)), np.empty((0, 10))
+        track_clear = obstacle_clearance_mask(candidates[:, 0], candidates[:, 1], reach, no_vias, no_pads, tracks, no_arcs, cell_size=4 * spacing_nm)
+        arc_clear = obstacle_clearance_mask(candidates[:, 0], candidates[:, 1], reach, no_vias, no_pads, no_tracks, arcs, cell_size=4 * spacing_nm)
+
+        # Each accepted via is bucketed into every cell within spacing_nm, so a candidate only checks its own cell.
+        spacing_sq = spacing_nm * spacing_nm
+        validated_grid = SpatialGrid(spacing_nm)
+        placed, rejected = [], []
+        for (px, py), track_ok, arc_ok in zip(candidate_points, track_clear.tolist(), arc_clear.tolist()):
             error_reason = ""
 
-            for vp in validated_points:
-                if (pos - vp).length() < spacing_nm:
+            for vx, vy in validated_grid.query(px, py):
+                if (px - vx) ** 2 + (py - vy) ** 2 < spacing_sq:
                     error_reason = "Spacing conflict with new via"
                     break
             if error_reason:
-                logging.debug(f"Candidate at ({pos.x}, {pos.y}) rejected: {error_reason}")
+                logging.debug(f"Candidate at ({px}, {py}) rejected: {error_reason}")
                 continue
 
-            for obs in obstacles:
-                if target_net and obs['net'] and obs['net'].name == target_net.name:
-                    continue
+            if not track_ok:
+                error_reason = "Conflict: Track"
+            elif not arc_ok:
+                error_reason = "Conflict: ArcTrack"
 
-                item = obs['item']
-                dist = float('inf')
-                obs_clearance = 0
-                
-                if isinstance(item, Track):
-                    dist, obs_clearance = point_segment_distance(pos, item.start, item.end), item.width / 2.0
-                elif isinstance(item, ArcTrack):
-                    dist, obs_clearance = point_arc_distance(pos, item), item.width / 2.0
+            if error_reason:
+                if self.debug_mode: rejected.append((px, py, error_reason))
+                continue
+            validated_grid.insert((px, py), px - spacing_nm, py - spacing_nm, px + spacing_nm, py + spacing_nm)
+            placed.append((px, py))
 
-                if dist < via_radius_nm + obs_clearance + clearance_nm:
-                    error_reason = f"Conflict: {obs['type']}"
-                    break
-            
-            if not error_reason:
-                validated_points.append(pos)
-                via = Via()
-                via.position, via.diameter, via.drill_diameter = pos, via_size_nm, drill_size_nm
-                if target_net: via.net = target_net
-                items_to_create.append(via)
-            
-            if self.debug_mode and error_reason:
-                via = Via()
-                via.position, via.diameter, via.drill_diameter = pos, via_size_nm, drill_size_nm
-                if target_net: via.net = target_net
-                items_to_create.append(via)
-                text = BoardText()
-                text.position = pos
-                text.value = error_reason
-                text.layer = BoardLayer.BL_Cmts_User
-                text.attributes.size = Vector2.from_xy(from_mm(0.2), from_mm(0.2))
-                items_to_create.append(text)
-
-        vias_created_count = len([i for i in items_to_create if isinstance(i, Via)])
-        logging.info(f"Found {vias_created_count} valid via positions.")
+        # Items are only built for the final positions; debug mode adds a via and a label per rejection.
+        items_to_create = []
+        for x, y in placed + [(x, y) for x, y, _ in rejected]:
+            via = Via()
+            via.position, via.diameter, via.drill_diameter = Vector2.from_xy(int(x), int(y)), via_size_nm, drill_size_nm
+            if target_net: via.net = target_net
+            items_to_create.append(via)
+        vias_created_count = len(items_to_create)
+        label_size = from_mm(0.2)
+        for x, y, error_reason in rejected:
+            text = BoardText()
+            text.position = Vector2.from_xy(int(x), int(y))
+            text.value = error_reason
+            text.layer = BoardLayer.BL_Cmts_User
+            text.attributes.size = Vector2.from_xy(label_size, label_size)
+            items_to_create.append(text)
+        logging.info(f"Found {len(placed)} valid via positions.")
 
         if not items_to_create:
             return 0
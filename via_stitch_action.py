@@ -6,11 +6,11 @@ import wx
 import sys
 import math
 import logging
-import random
 import kipy
 import argparse
+import numpy as np
 from kipy.board import Board
-from kipy.board_types import (BoardCircle, BoardPolygon, BoardRectangle,
+from kipy.board_types import (BoardCircle, BoardRectangle,
                              BoardSegment, BoardShape, Pad, Track, Via, ArcTrack, Zone, BoardText, BoardTextBox, ViaType)
 from kipy.errors import ApiError
 from kipy.geometry import Box2, Vector2
@@ -21,11 +21,37 @@ from stitching_utils import *
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Layer mask of an obstacle with no layer information, which blocks vias on every layer.
+ALL_LAYERS = (1 << 64) - 1
+
+def copper_layer_bits(layers) -> int:
+    """Bitmask with bit n set for each copper BoardLayer n in layers (one layer or a padstack's layer list)."""
+    if isinstance(layers, int): layers = (layers,)
+    return sum(1 << l for l in set(layers) if is_copper_layer(l))
+
+def candidate_chunks(center, half_cols, half_rows, spacing_nm, row_offset_nm, jitter_nm=None, chunk_size=65536):
+    """Yields the stitching grid as (xs, ys) blocks of whole rows, about chunk_size points each."""
+    cols = center.x + np.arange(-half_cols, half_cols + 1) * spacing_nm
+    rows = np.arange(-half_rows, half_rows + 1)
+    step = max(1, chunk_size // len(cols))
+    for start in range(0, len(rows), step):
+        block = rows[start:start + step]
+        # Odd rows are shifted by the row offset.
+        grid_x, grid_y = np.meshgrid(cols, center.y + block * spacing_nm)
+        grid_x[block % 2 != 0] += row_offset_nm
+        xs, ys = grid_x.ravel().astype(np.float64), grid_y.ravel().astype(np.float64)
+        if jitter_nm:
+            # One draw covers both axes; the per-axis bounds broadcast over the last dimension.
+            jitter = np.random.uniform((-jitter_nm[0], -jitter_nm[1]), jitter_nm, xs.shape + (2,))
+            xs, ys = xs + jitter[:, 0], ys + jitter[:, 1]
+        yield np.trunc(xs), np.trunc(ys)
+
 class StitcherDialog(wx.Dialog):
     def __init__(self, parent):
         super(StitcherDialog, self).__init__(parent, title="Via Stitching Tool", style=wx.DEFAULT_DIALOG_STYLE | wx.STAY_ON_TOP)
         self.debug_mode = False
         self.kicad, self.board = None, None
+        self.nets_by_name, self.netclasses_by_name = {}, {}
         top_sizer = wx.BoxSizer(wx.VERTICAL)
         panel = wx.Panel(self)
         grid_sizer = wx.GridBagSizer(5, 5)
@@ -129,22 +155,22 @@ class StitcherDialog(wx.Dialog):
                 self.m_stitch_layers_only_checkbox.Disable()
 
             all_nets = sorted(self.board.get_nets(), key=lambda n: n.name)
+            self.nets_by_name = {n.name: n for n in all_nets}
             net_names = [n.name for n in all_nets if "unconnected" not in n.name.lower()]
             self.m_net_choice.Append("[No Net]"), self.m_net_choice.Append(net_names), self.m_net_choice.SetSelection(0)
             
             if self.selected_zones:
                 zone_net = self.selected_zones[0].net
-                if zone_net:
-                    try:
-                        idx = net_names.index(zone_net.name)
-                        self.m_net_choice.SetSelection(idx + 1)
-                    except ValueError:
-                        pass
+                # Choice index by name; entry 0 is "[No Net]".
+                net_choice_index = {name: i + 1 for i, name in enumerate(net_names)}
+                if zone_net and zone_net.name in net_choice_index:
+                    self.m_net_choice.SetSelection(net_choice_index[zone_net.name])
 
             netclasses = []
             if all_nets:
                 netclass_map = self.board.get_netclass_for_nets(all_nets)
-                netclasses = sorted(list(set(nc.name for nc in netclass_map.values())))
+                self.netclasses_by_name = {nc.name: nc for nc in netclass_map.values()}
+                netclasses = sorted(self.netclasses_by_name)
             self.m_netclass_choice.Append(netclasses)
             if "Default" in netclasses: self.m_netclass_choice.SetStringSelection("Default")
             elif len(netclasses) > 0: self.m_netclass_choice.SetSelection(0)
@@ -195,9 +221,8 @@ class StitcherDialog(wx.Dialog):
         else:
             target_netclass_name = params['netclass_name']
             if not target_netclass_name: raise Exception("No netclass selected.")
-            nets_in_class = self.board.get_nets(netclass_filter=target_netclass_name)
-            if not nets_in_class: raise Exception(f"Netclass '{target_netclass_name}' not found.")
-            netclass_obj = list(self.board.get_netclass_for_nets(nets_in_class[0]).values())[0]
+            netclass_obj = self.netclasses_by_name.get(target_netclass_name)
+            if not netclass_obj: raise Exception(f"Netclass '{target_netclass_name}' not found.")
             via_size_nm, drill_size_nm = netclass_obj.via_diameter, netclass_obj.via_drill
             if not via_size_nm or not drill_size_nm: raise Exception(f"Netclass '{target_netclass_name}' has invalid via dimensions.")
 
@@ -221,125 +246,152 @@ class StitcherDialog(wx.Dialog):
                     continue
                 for layer, polys in zone.filled_polygons.items():
                     for poly in polys:
-                        stitch_areas.append({'poly': poly, 'zone': zone})
+                        stitch_areas.append({'segments': get_polygon_with_holes_segments(poly), 'zone': zone})
             if not stitch_areas: raise Exception("Selected zones have no filled areas to stitch.")
             bbox = get_enclosing_bbox(self.board, self.selected_zones)
         else:
             outline_shapes = [s for s in self.board.get_shapes() if s.layer == BoardLayer.BL_Edge_Cuts]
             if not outline_shapes: raise Exception("No valid board outline found.")
             bbox = get_enclosing_bbox(self.board, outline_shapes)
-            if bbox:
-                outline_poly = BoardPolygon()
-                outline_poly.polygons.append(kipy.geometry.PolygonWithHoles())
-                outline_poly.polygons[0].outline.nodes.extend([
-                    kipy.geometry.PolyLineNode.from_point(bbox.pos),
-                    kipy.geometry.PolyLineNode.from_point(Vector2.from_xy(bbox.pos.x + bbox.size.x, bbox.pos.y)),
-                    kipy.geometry.PolyLineNode.from_point(Vector2.from_xy(bbox.pos.x + bbox.size.x, bbox.pos.y + bbox.size.y)),
-                    kipy.geometry.PolyLineNode.from_point(Vector2.from_xy(bbox.pos.x, bbox.pos.y + bbox.size.y)),
-                ])
-                outline_poly.polygons[0].outline.closed = True
-                stitch_areas.append({'poly': outline_poly.polygons[0], 'zone': None})
+            # Containment is tested against the real Edge.Cuts edges, so vias never land outside a non-rectangular board.
+            outline_segments = get_outline_segments(self.board, outline_shapes)
+            if len(outline_segments) == 0: raise Exception("No valid board outline found.")
+            # Even-odd containment is meaningless on an open ring; it would reject whole rows of the board.
+            if outline_open_ends(outline_segments): raise Exception("Board outline on Edge.Cuts is not closed.")
+            stitch_areas.append({'segments': outline_segments, 'zone': None})
 
         if not bbox: raise Exception("Could not determine board bounding box.")
         logging.info(f"Found {len(stitch_areas)} stitch areas. Bounding box: {bbox.pos.x}, {bbox.pos.y} -> {bbox.pos.x+bbox.size.x}, {bbox.pos.y+bbox.size.y}")
         
-        target_net = next((n for n in self.board.get_nets() if n.name == params['net_name']), None) if params['net_name'] else None
+        target_net = self.nets_by_name.get(params['net_name']) if params['net_name'] else None
         
-        obstacles = []
         all_items = self.board.get_items([KiCadObjectType.KOT_PCB_PAD, KiCadObjectType.KOT_PCB_VIA, KiCadObjectType.KOT_PCB_TRACE, KiCadObjectType.KOT_PCB_ARC])
+
+        # --- Obstacle Data ---
+        # Every obstacle is read from KiCad once into a float row per kind: vias and pads as (x, y, radius)
+        # circles, tracks as (sx, sy, ex, ey, half_width) and arcs as get_arc_geometry rows.
+        # obstacle_layer_bits holds the matching copper layer mask for each row. Copper on the target net is dropped here.
+        VIA, PAD, TRACK, ARC = 0, 1, 2, 3
+        KIND_NAMES = ('Via', 'Pad', 'Track', 'ArcTrack')
+        obstacle_rows, obstacle_layer_bits = ([], [], [], []), ([], [], [], [])
+        # kipy identifies nets by name (net codes are deprecated), so the target's name is read once.
+        target_net_name = target_net.name if target_net else None
         for item in all_items:
-            obstacles.append({'item': item, 'net': getattr(item, 'net', None), 'type': item.__class__.__name__})
-        logging.info(f"Collected {len(obstacles)} obstacles.")
+            obs_net = getattr(item, 'net', None)
+            if target_net_name and obs_net and obs_net.name == target_net_name:
+                continue
+            geometry = get_arc_geometry(item) if isinstance(item, ArcTrack) else None
+            if isinstance(item, Via):
+                position = item.position
+                kind, row = VIA, (position.x, position.y, item.diameter / 2.0)
+            elif isinstance(item, Pad):
+                position = item.position
+                pad_layer = item.padstack.copper_layer(BoardLayer.BL_F_Cu) or item.padstack.copper_layer(BoardLayer.BL_B_Cu)
+                kind, row = PAD, (position.x, position.y, max(pad_layer.size.x, pad_layer.size.y) / 2.0 if pad_layer else 0)
+            elif geometry:
+                kind, row = ARC, geometry
+            elif isinstance(item, (Track, ArcTrack)):
+                # Degenerate arcs are checked as the straight track between their endpoints.
+                start, end = item.start, item.end
+                kind, row = TRACK, (start.x, start.y, end.x, end.y, item.width / 2.0)
+            else:
+                continue
+            obs_layer = getattr(item, 'layer', None)
+            if obs_layer is None and hasattr(item, 'padstack'):
+                obs_layer = item.padstack.layers
+            obstacle_rows[kind].append(row)
+            obstacle_layer_bits[kind].append(copper_layer_bits(obs_layer) if obs_layer else ALL_LAYERS)
+        obstacle_arrays = [np.asarray(rows, dtype=np.float64).reshape(-1, width) for rows, width in zip(obstacle_rows, (3, 3, 5, 10))]
+        obstacle_layer_bits = [np.array(bits, dtype=np.uint64) for bits in obstacle_layer_bits]
+        logging.info(f"Collected {sum(map(len, obstacle_rows))} obstacles.")
 
-        candidate_positions = []
         center = bbox.center()
         half_cols = int(bbox.size.x / (2.0 * spacing_nm)) if spacing_nm > 0 else 0
         half_rows = int(bbox.size.y / (2.0 * spacing_nm)) if spacing_nm > 0 else 0
-        for i in range(-half_rows, half_rows + 1):
-            row_x_offset = row_offset_nm if i % 2 != 0 else 0
-            for j in range(-half_cols, half_cols + 1):
-                x_pos = center.x + j * spacing_nm + row_x_offset
-                y_pos = center.y + i * spacing_nm
-                if random_variance:
-                    x_pos += random.uniform(-max_x_variance_nm, max_x_variance_nm)
-                    y_pos += random.uniform(-max_y_variance_nm, max_y_variance_nm)
-                pos = Vector2.from_xy(int(x_pos), int(y_pos))
-                
-                for area in stitch_areas:
-                    if is_point_inside_polygon_with_holes(pos, area['poly']):
-                        if point_polygon_distance(pos, area['poly']) >= via_radius_nm + edge_clearance_nm:
-                            candidate_positions.append({'pos': pos, 'zone': area['zone']})
-                            break
+        jitter_nm = (max_x_variance_nm, max_y_variance_nm) if random_variance else None
+
+        # Each point goes to the first stitch area that contains it with enough room to the area's edges.
+        # The grid is streamed in row blocks and only the points that land in an area are kept.
+        edge_margin = via_radius_nm + edge_clearance_nm
+        # Areas are rasterized at a few grid pitches, so only points near an area's edges get the exact test.
+        raster_nm = 4 * spacing_nm
+        kept_x, kept_y, kept_area = [], [], []
+        for xs, ys in candidate_chunks(center, half_cols, half_rows, spacing_nm, row_offset_nm, jitter_nm):
+            area_of = np.full(len(xs), -1)
+            for k, area in enumerate(stitch_areas):
+                idx = np.flatnonzero(area_of < 0)
+                area_of[idx[points_outline_mask(xs[idx], ys[idx], area['segments'], edge_margin, raster_nm)]] = k
+            chosen = np.flatnonzero(area_of >= 0)
+            kept_x.append(xs[chosen]); kept_y.append(ys[chosen]); kept_area.append(area_of[chosen])
+        cand_x, cand_y, cand_area = np.concatenate(kept_x), np.concatenate(kept_y), np.concatenate(kept_area)
         
-        logging.info(f"Generated {len(candidate_positions)} candidate positions inside stitch areas.")
-        if not candidate_positions:
+        logging.info(f"Generated {len(cand_x)} candidate positions inside stitch areas.")
+        if not len(cand_x):
             raise Exception("No valid positions for vias found within the specified area and clearance.")
 
-        items_to_create = []
-        validated_points = []
-        for cand in candidate_positions:
-            pos, zone = cand['pos'], cand['zone']
-            
-            error_reason = ""
-
-            for vp in validated_points:
-                if (pos - vp).length() < spacing_nm:
-                    error_reason = "Spacing conflict with new via"
-                    break
-            if error_reason:
-                logging.debug(f"Candidate at ({pos.x}, {pos.y}) rejected: {error_reason}")
+        # Layer filtering only depends on the candidate's zone, so each distinct zone layer mask is ANDed
+        # with every obstacle's mask once, giving one keep-flag array per obstacle kind.
+        layer_masks, zone_layer_masks = {}, {}
+        if params['stitch_layers_only']:
+            for area in stitch_areas:
+                zone = area['zone']
+                if not zone or id(zone) in zone_layer_masks: continue
+                key = copper_layer_bits(zone.layers)
+                if not key: continue
+                if key not in layer_masks:
+                    layer_masks[key] = tuple((bits & np.uint64(key)) != 0 for bits in obstacle_layer_bits)
+                zone_layer_masks[id(zone)] = layer_masks[key]
+
+        # --- Vectorized clearance checks ---
+        # Candidates sharing a layer filter are checked together, one obstacle kind at a time. Each pass only
+        # tests the points every earlier kind cleared, so a rejected point keeps the first kind it hit.
+        reach = via_radius_nm + clearance_nm
+        cell_size = 2 * (spacing_nm + via_radius_nm)
+        no_circles, no_pads, no_tracks, no_arcs = np.empty((0, 3)), np.empty((0, 5)), np.empty((0, 5)), np.empty((0, 10))
+        conflict = np.full(len(cand_x), -1)
+        area_masks = [zone_layer_masks.get(id(area['zone'])) for area in stitch_areas]
+        for layer_ok in {id(m): m for m in area_masks}.values():
+            group = np.flatnonzero(np.isin(cand_area, [k for k, m in enumerate(area_masks) if m is layer_ok]))
+            for kind, rows in enumerate(obstacle_arrays):
+                if layer_ok is not None: rows = rows[layer_ok[kind]]
+                if len(rows) == 0 or len(group) == 0: continue
+                px, py = cand_x[group], cand_y[group]
+                if kind in (VIA, PAD):
+                    keep = obstacle_clearance_mask(px, py, reach, rows, no_pads, no_tracks, no_arcs, cell_size)
+                elif kind == TRACK:
+                    keep = obstacle_clearance_mask(px, py, reach, no_circles, no_pads, rows, no_arcs, cell_size)
+                else:
+                    keep = obstacle_clearance_mask(px, py, reach, no_circles, no_pads, no_tracks, rows, cell_size)
+                conflict[group[~keep]] = kind
+                group = group[keep]
+
+        # Outside debug mode a rejected candidate never reaches the board, so only clear ones enter the loop.
+        if not self.debug_mode:
+            clear = conflict < 0
+            cand_x, cand_y, conflict = cand_x[clear], cand_y[clear], conflict[clear]
+
+        # Each placed via is bucketed into every cell within spacing_nm, so a candidate only checks its own cell.
+        validated_grid = SpatialGrid(spacing_nm)
+        # Distances are compared squared so the candidate loop never takes a square root.
+        spacing_sq = spacing_nm * spacing_nm
+        placed = []
+        for x, y, kind in zip(cand_x.astype(np.int64).tolist(), cand_y.astype(np.int64).tolist(), conflict.tolist()):
+            if any((x - vx) ** 2 + (y - vy) ** 2 < spacing_sq for vx, vy in validated_grid.query(x, y)):
+                logging.debug(f"Candidate at ({x}, {y}) rejected: Spacing conflict with new via")
                 continue
+            validated_grid.insert((x, y), x - spacing_nm, y - spacing_nm, x + spacing_nm, y + spacing_nm)
+            placed.append((x, y, f"Conflict: {KIND_NAMES[kind]}" if kind >= 0 else ""))
 
-            if not error_reason:
-                via_layers = None
-                if zone and params['stitch_layers_only']:
-                    via_layers = zone.layers
-
-                for obs in obstacles:
-                    if target_net and obs['net'] and obs['net'].name == target_net.name:
-                        continue
-                    
-                    obs_layer = getattr(obs['item'], 'layer', None)
-                    if obs_layer is None and hasattr(obs['item'], 'padstack'):
-                        obs_layer = obs['item'].padstack.layers
-
-                    if via_layers and obs_layer:
-                        if isinstance(obs_layer, list):
-                            if not any(l in via_layers for l in obs_layer):
-                                continue
-                        elif obs_layer not in via_layers:
-                            continue
-
-                    item = obs['item']
-                    dist = float('inf')
-                    obs_clearance = 0
-                    if isinstance(item, Via):
-                        dist, obs_clearance = (pos - item.position).length(), item.diameter / 2.0
-                    elif isinstance(item, Pad):
-                        dist = (pos - item.position).length()
-                        pad_layer = item.padstack.copper_layer(BoardLayer.BL_F_Cu) or item.padstack.copper_layer(BoardLayer.BL_B_Cu)
-                        obs_clearance = max(pad_layer.size.x, pad_layer.size.y) / 2.0 if pad_layer else 0
-                    elif isinstance(item, Track):
-                        dist, obs_clearance = point_segment_distance(pos, item.start, item.end), item.width / 2.0
-                    elif isinstance(item, ArcTrack):
-                        dist, obs_clearance = point_arc_distance(pos, item), item.width / 2.0
-
-                    if dist < via_radius_nm + obs_clearance + clearance_nm:
-                        error_reason = f"Conflict: {obs['type']}"
-                        break
-            
-            is_valid = not error_reason
-
-            if not is_valid and not self.debug_mode:
-                continue
-
-            validated_points.append(pos)
+        # Board items are only built for the positions that survived, then created in one call.
+        items_to_create = []
+        for x, y, error_reason in placed:
+            pos = Vector2.from_xy(x, y)
             via = Via()
             via.position, via.diameter, via.drill_diameter = pos, via_size_nm, drill_size_nm
             if target_net: via.net = target_net
             items_to_create.append(via)
 
-            if not is_valid and self.debug_mode:
+            if error_reason:
                 text = BoardText()
                 text.position = pos
                 text.value = error_reason
@@ -347,7 +399,7 @@ class StitcherDialog(wx.Dialog):
                 text.attributes.size = Vector2.from_xy(from_mm(0.2), from_mm(0.2))
                 items_to_create.append(text)
 
-        vias_created_count = len([i for i in items_to_create if isinstance(i, Via)])
+        vias_created_count = len(placed)
         logging.info(f"Found {vias_created_count} valid via positions.")
         if not items_to_create:
             return 0